@@ -3,6 +3,7 @@
 import streamlit as st
 import os
 import time
+from vector_store import vector_store_exists
 
 st.set_page_config(
     page_title="防災計画アセスメント自動化ツール",
@@ -23,7 +24,7 @@ with st.sidebar:
     st.markdown("---")
     st.markdown("**処理ステータス**")
 
-    if os.path.exists("./chroma_db"):
+    if vector_store_exists():
         st.success("✅ RAGデータベース：構築済み")
     else:
         st.warning("⚠️ RAGデータベース：未構築")
@@ -96,11 +97,14 @@ with tab2:
         st.warning("先にStep1でテキスト抽出を完了させてください")
     else:
         if st.button("▶️ RAG構築を開始"):
-            from phase2_build_rag import load_text, split_into_chunks, build_chroma_db
+            from phase2_build_rag import load_text, chunk_text, build_chroma_db, DEDUP_ENABLED
+            from phase2_dedup import dedup_chunks
 
             with st.spinner("RAGデータベースを構築中..."):
                 text   = load_text("output_text.txt")
-                chunks = split_into_chunks(text, chunk_size=400, overlap=80)
+                chunks = chunk_text(text, chunk_size=400, overlap=80)
+                if DEDUP_ENABLED:
+                    chunks = dedup_chunks(chunks)
                 build_chroma_db(chunks)
 
             st.success(f"✅ RAG構築完了！（{len(chunks)} チャンク）")
@@ -111,7 +115,7 @@ with tab2:
 with tab3:
     st.subheader("105問の質問票に自動回答してExcelを出力します")
 
-    if not os.path.exists("./chroma_db"):
+    if not vector_store_exists():
         st.warning("先にStep2でRAGを構築してください")
     else:
         col1, col2 = st.columns([2, 1])
@@ -119,33 +123,73 @@ with tab3:
         with col1:
             st.markdown("""
             **処理の流れ：**
-            1. QuestionSpecの検索クエリでChromaDBを検索
-            2. 105問を10問ずつバッチ化してGemini APIへ投げる（約11回）
-            3. 回答をExcelに書き込んで返却
+            1. QuestionSpecの検索クエリでベクトルストアを検索
+            2. 入力・出力のトークン予算に収まるだけ質問をまとめてGemini APIへ投げる
+            3. 回答が届いた順に下の表へ表示し、バッチごとにExcelへ途中保存
             """)
 
         with col2:
-            st.metric("API呼び出し回数（目安）", "約11回")
+            # 呼び出し回数はトークン予算によるバッチ分けで決まるので、開始後に表示する
+            calls_metric = st.empty()
+            calls_metric.metric("API呼び出し回数", "－", help="回答生成の開始時に、質問とトークン予算から決まります")
             st.metric("処理時間（目安）", "約3〜5分")
 
+        # phase3_answer_engine.CHECKPOINT_FILE と同じファイル
+        # （画面表示のたびに torch や Gemini の重いimportが走らないよう、ここでは import しない）
+        checkpoint_file = "answers_checkpoint.json"
+        resume = st.checkbox(
+            "前回の途中結果から再開する",
+            value=False,
+            disabled=not os.path.exists(checkpoint_file),
+            help="中断した回の回答済みの問を飛ばして、残りの問だけ回答します",
+        )
+
         if st.button("▶️ 回答生成を開始", type="primary"):
             from phase3_answer_engine import answer_all
-            from phase3_excel_writer import write_answers_to_excel
+            from phase3_excel_writer import write_answers_to_excel, default_output_path
 
             progress_bar  = st.progress(0)
             status_text   = st.empty()
+            results_table = st.empty()
+            output_path   = default_output_path()
+            rows = {}
 
             status_text.write("🔄 回答生成中...")
 
-            def update_progress(ratio):
-                progress_bar.progress(ratio)
-                batch_num  = int(ratio * 11)
-                status_text.write(f"🔄 バッチ処理中... {batch_num}/11")
+            def update_progress(done, total):
+                calls_metric.metric("API呼び出し回数", f"{total}回")
+                progress_bar.progress(done / total if total else 1.0)
+                status_text.write(f"🔄 バッチ処理中... {done}/{total}（途中経過を {output_path} に保存済み）")
+
+            def show_answer(qid, entry):
+                # 回答が届いた順に結果テーブルを更新する
+                pages = entry.get("evidence_pages", [])
+                rows[qid] = {
+                    "QID":        qid,
+                    "回答":       entry.get("answer", ""),
+                    "根拠ページ": ", ".join(str(p) for p in pages),
+                }
+                results_table.dataframe(
+                    [rows[k] for k in sorted(rows)],
+                    use_container_width=True,
+                    hide_index=True,
+                )
+
+            def save_checkpoint(answers):
+                # バッチごとに途中経過のExcelを書き出す（中断しても完了分は残る）
+                write_answers_to_excel(answers, output_path=output_path)
 
-            answers = answer_all(progress_callback=update_progress)
+            answers = answer_all(
+                progress_callback   = update_progress,
+                answer_callback     = show_answer,
+                checkpoint_callback = save_checkpoint,
+                resume              = resume,
+            )
 
             status_text.write("📝 Excelに書き込み中...")
-            output_path = write_answers_to_excel(answers)
+            output_path = write_answers_to_excel(answers, output_path=output_path)
+            if os.path.exists(checkpoint_file):
+                os.remove(checkpoint_file)   # 完了したら途中結果は不要
 
             progress_bar.progress(1.0)
             status_text.success("✅ 完了！")
@@ -0,0 +1,45 @@
+# perf_stats.py
+
+# ===================================================
+# 計測ユーティリティ（ベンチマーク・ビルド統計用）
+# ===================================================
+def percentile(values: list[float], pct: float) -> float:
+    """
+    values の pct パーセンタイル（0〜100）を線形補間で返す
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    pos  = (len(ordered) - 1) * pct / 100
+    low  = int(pos)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (pos - low)
+
+
+def latency_summary(latencies_ms: list[float]) -> str:
+    """レイテンシ（ミリ秒）のリストを p50 / p95 / p99 の1行にまとめる"""
+    return (f"p50={percentile(latencies_ms, 50):.2f}ms  "
+            f"p95={percentile(latencies_ms, 95):.2f}ms  "
+            f"p99={percentile(latencies_ms, 99):.2f}ms")
+
+
+def peak_memory_mb() -> float | None:
+    """
+    このプロセスのピークメモリ使用量（MB）を返す。
+    Linux/Macは標準ライブラリのresource、Windowsはpsutilがあれば使う。計測できなければNone。
+    """
+    try:
+        import resource
+        import sys
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linuxは KB 単位、Macは byte 単位
+        return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+    except ImportError:
+        pass
+
+    try:
+        import psutil
+        info = psutil.Process().memory_info()
+        return getattr(info, "peak_wset", info.rss) / (1024 * 1024)
+    except ImportError:
+        return None
@@ -0,0 +1,121 @@
+# phase2_bench_store.py
+
+import os
+import sys
+import time
+import subprocess
+from sentence_transformers import SentenceTransformer
+from question_spec import load_question_spec, make_search_query
+from perf_stats import percentile, latency_summary
+from phase3_answer_engine import TOP_K
+from vector_store import ChromaVectorStore, NumpyVectorStore
+
+# ===================================================
+# 設定
+# ===================================================
+EMBED_MODEL = "paraphrase-multilingual-mpnet-base-v2"
+COLD_RUNS   = 3     # コールドオープン計測の繰り返し回数（中央値を採用）
+BENCH_DIR   = "./bench_index"   # 比較用NumPyインデックスの保存先（ChromaDBから変換して作る）
+DTYPES      = ["float16", "int8"]
+# 取得件数は phase3_answer_engine の TOP_K（回答生成時と同じ）を使う
+
+
+# ===================================================
+# ChromaDBの中身をNumPyインデックスに変換する
+# ===================================================
+def export_chroma_to_numpy(chroma: ChromaVectorStore, path: str, dtype: str) -> NumpyVectorStore:
+    data = chroma.collection.get(include=["embeddings", "documents", "metadatas"])
+    store = NumpyVectorStore.create(path, dtype)
+    store.add(data["ids"], data["documents"], data["embeddings"], data["metadatas"])
+    store.flush()
+    return store
+
+
+# ===================================================
+# コールドオープン（別プロセスでimport〜初回検索まで）
+# ===================================================
+_COLD_SCRIPT = """
+import time
+t0 = time.perf_counter()
+from vector_store import {cls}
+store = {cls}.open({args})
+dim = {dim}
+store.query([[1.0] * dim], n_results={k})
+print(time.perf_counter() - t0)
+"""
+
+
+def measure_cold_open(cls_name: str, args: str, dim: int) -> float:
+    """別プロセスで import + open + 初回検索 にかかる秒数（中央値）を返す"""
+    script = _COLD_SCRIPT.format(cls=cls_name, args=args, dim=dim, k=TOP_K)
+    times = []
+    for _ in range(COLD_RUNS):
+        out = subprocess.run(
+            [sys.executable, "-c", script],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+        times.append(float(out.stdout.strip().splitlines()[-1]))
+    return percentile(times, 50)
+
+
+# ===================================================
+# 検索レイテンシ（1件ずつ / 一括）
+# ===================================================
+def measure_queries(store, query_vectors) -> dict:
+    single_ms = []
+    for vec in query_vectors:
+        t0 = time.perf_counter()
+        store.query([vec], n_results=TOP_K)
+        single_ms.append((time.perf_counter() - t0) * 1000)
+
+    t0 = time.perf_counter()
+    batched = store.query(query_vectors, n_results=TOP_K)
+    batch_ms = (time.perf_counter() - t0) * 1000
+
+    return {"single_ms": single_ms, "batch_ms": batch_ms, "results": batched}
+
+
+def overlap_at_k(base: dict, other: dict) -> float:
+    """ChromaDBの上位k件とどれだけ一致するか（近似検索・量子化の影響確認用）"""
+    hits = total = 0
+    for a, b in zip(base["ids"], other["ids"]):
+        hits  += len(set(a) & set(b))
+        total += len(a)
+    return hits / total if total else 0.0
+
+
+# ===================================================
+# メイン処理
+# ===================================================
+if __name__ == "__main__":
+    print("=== ベクトルストア ベンチマーク（ChromaDB vs NumPy） ===\n")
+
+    model   = SentenceTransformer(EMBED_MODEL)
+    queries = [make_search_query(q) for q in load_question_spec()]
+    query_vectors = model.encode(queries, show_progress_bar=False)
+    dim = query_vectors.shape[1]
+
+    chroma = ChromaVectorStore.open()
+    print(f"総チャンク数: {chroma.count()} 件 / クエリ数: {len(queries)} 件\n")
+
+    rows = []
+    chroma_stats = measure_queries(chroma, query_vectors)
+    chroma_cold  = measure_cold_open("ChromaVectorStore", "", dim)
+    rows.append(("chroma", chroma_cold, chroma_stats, 1.0))
+
+    for dtype in DTYPES:
+        path = f"{BENCH_DIR}_{dtype}"
+        export_chroma_to_numpy(chroma, path, dtype)
+        store = NumpyVectorStore.open(path)
+        stats = measure_queries(store, query_vectors)
+        cold  = measure_cold_open("NumpyVectorStore", repr(path), dim)
+        rows.append((f"numpy-{dtype}", cold, stats,
+                     overlap_at_k(chroma_stats["results"], stats["results"])))
+
+    for name, cold, stats, overlap in rows:
+        print(f"[{name}]")
+        print(f"   コールドオープン（import〜初回検索）: {cold * 1000:.1f}ms")
+        print(f"   1件ずつ検索: {latency_summary(stats['single_ms'])}")
+        print(f"   {len(queries)}件一括検索: {stats['batch_ms']:.2f}ms")
+        print(f"   ChromaDB上位{TOP_K}件との一致率: {overlap:.1%}\n")
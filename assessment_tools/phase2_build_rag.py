@@ -2,22 +2,35 @@
 
 import os
 import re
-import chromadb
+import time
+import queue
+import threading
 from sentence_transformers import SentenceTransformer
+from perf_stats import peak_memory_mb
+from phase2_dedup import dedup_chunks
+from vector_store import VECTOR_BACKEND, create_vector_store, publish_vector_store
 
 # ===================================================
 # 設定（ここだけ変更すればOK）
 # ===================================================
 INPUT_TEXT_FILE = "output_text.txt"   # フェーズ1で作ったテキストファイル
-CHROMA_DB_PATH  = "./chroma_db"       # ChromaDBの保存先フォルダ
-COLLECTION_NAME = "manual_chunks"     # DB内のコレクション名（テーブル名のようなもの）
+# 保存先・バックエンド（chroma / numpy）は vector_store.py で設定
 
 CHUNK_SIZE    = 400   # チャンク1つあたりの最大文字数
 CHUNK_OVERLAP = 80    # 前のチャンクと重複させる文字数（文脈を切らさないため）
+CHUNK_STRATEGY = "markdown"   # "markdown": 見出し・表単位で分割 / "window": 固定長で分割（従来方式）
+DEDUP_ENABLED = True  # ほぼ同じ内容のチャンク（ヘッダー・目次・定型文）を1つにまとめる
 
 # 埋め込みモデル（日本語対応・無料・ローカル動作）
 EMBED_MODEL = "paraphrase-multilingual-mpnet-base-v2"
 
+# ベクトル化の並列・パイプライン設定
+EMBED_BATCH_SIZE = 64        # 1回のencodeに渡すチャンク数（トークン長の近いもの同士でまとめる）
+EMBED_WORKERS    = 1         # 2以上でCPUのマルチプロセス並列エンコード
+EMBED_BACKEND    = "torch"   # "onnx" にするとONNX Runtimeで推論（sentence-transformers 3.2以降）
+EMBED_ONNX_FILE  = None      # 量子化ONNXを使う場合のファイル名（例: "onnx/model_qint8_avx2.onnx"）
+WRITE_QUEUE_SIZE = 4         # エンコード済みで書き込み待ちにできるバッチ数（メモリ上限）
+
 
 # ===================================================
 # Step1: テキストファイルを読み込む
@@ -33,6 +46,53 @@ def load_text(filepath: str) -> str:
 # ===================================================
 # Step2: テキストをチャンクに分割する
 # ===================================================
+def split_pages(text: str) -> list[tuple[str, int, str]]:
+    """
+    ファイル区切り「=== ファイル: XX ===」（app.pyで複数PDFを結合した場合）と
+    ページ区切り「--- ページ XX ---」でテキストを分け、
+    (ファイル名, ページ番号, 本文) のリストを返す。ファイル区切りがなければファイル名は空文字。
+    """
+    file_pattern = re.compile(r"=== ファイル: (.+?) ===")
+    page_pattern = re.compile(r"--- ページ (\d+) ---")
+
+    # ファイル区切りで分ける（区切りより前の部分はファイル名なし）
+    file_parts = file_pattern.split(text)
+    documents = [("", file_parts[0])] + list(zip(file_parts[1::2], file_parts[2::2]))
+
+    pages = []
+    for document, doc_text in documents:
+        parts = page_pattern.split(doc_text)
+
+        # parts は [前テキスト, ページ番号, 本文, ページ番号, 本文, ...] の形になる
+        i = 1
+        while i < len(parts) - 1:
+            page_num = int(parts[i])
+            page_text = parts[i + 1].strip()
+            if page_text:
+                pages.append((document.strip(), page_num, page_text))
+            i += 2
+    return pages
+
+
+def sliding_window(text: str, chunk_size: int, overlap: int):
+    """固定長（chunk_size文字）・重複（overlap文字）で切り出したテキストを順に返す"""
+    if overlap >= chunk_size:
+        # 開始位置が進まず無限ループになるため
+        raise ValueError(f"重複文字数（{overlap}）はチャンクサイズ（{chunk_size}）より小さくしてください")
+    start = 0
+    while start < len(text):
+        end = start + chunk_size
+        piece = text[start:end]
+
+        if piece.strip():   # 空白だけのチャンクはスキップ
+            yield piece
+
+        # 次の開始位置（overlapぶん戻す）
+        start = end - overlap
+        if start >= len(text):
+            break
+
+
 def split_into_chunks(text: str, chunk_size: int, overlap: int) -> list[dict]:
     """
     テキストを小さな塊（チャンク）に分割する。
@@ -41,103 +101,362 @@ def split_into_chunks(text: str, chunk_size: int, overlap: int) -> list[dict]:
     """
     print(f"\n✂️  チャンク分割中（1チャンク={chunk_size}文字, 重複={overlap}文字）")
 
-    # ページ区切りで分割
-    page_pattern = re.compile(r"--- ページ (\d+) ---")
-    parts = page_pattern.split(text)
+    pages = split_pages(text)
+    print(f"   → 検出ページ数: {len(pages)} ページ")
 
-    # parts は [前テキスト, ページ番号, 本文, ページ番号, 本文, ...] の形になる
+    # 各ページをさらに細かく分割
     chunks = []
-    chunk_id = 0
+    for document, page_num, page_text in pages:
+        for piece in sliding_window(page_text, chunk_size, overlap):
+            chunks.append({
+                "id":       f"chunk_{len(chunks):04d}",
+                "text":     piece,
+                "page_num": page_num,
+                "document": document,
+                "scope":    "共通",   # 見出しがないため災害種別は判定しない
+            })
 
-    # ページ番号と本文をペアにする
-    pages = []
-    i = 1
-    while i < len(parts) - 1:
-        page_num = int(parts[i])
-        page_text = parts[i + 1].strip()
-        if page_text:
-            pages.append((page_num, page_text))
-        i += 2
+    print(f"   → 生成チャンク数: {len(chunks)} 個")
+    return chunks
 
-    print(f"   → 検出ページ数: {len(pages)} ページ")
 
-    # 各ページをさらに細かく分割
-    for page_num, page_text in pages:
-        start = 0
-        while start < len(page_text):
-            end = start + chunk_size
-            chunk_text = page_text[start:end]
-
-            if chunk_text.strip():   # 空白だけのチャンクはスキップ
-                chunks.append({
-                    "id":       f"chunk_{chunk_id:04d}",
-                    "text":     chunk_text,
-                    "page_num": page_num,
-                })
-                chunk_id += 1
-
-            # 次の開始位置（overlapぶん戻す）
-            start = end - overlap
-            if start >= len(page_text):
-                break
+# ---------------------------------------------------
+# Markdown構造に沿った分割（見出し・表・箇条書きを途中で切らない）
+# ---------------------------------------------------
+_HEADING_RE = re.compile(r"^(#{1,6})\s+(.+?)\s*#*\s*$")
+_TABLE_RE   = re.compile(r"^\s*\|")
+_LIST_RE    = re.compile(r"^\s*([-*+・]|\d+[.)．]|[(（]\d+[)）])\s*")
+_FENCE_RE   = re.compile(r"^\s*```")
+
+# 見出しに含まれていれば、その災害種別の記述とみなすキーワード（QuestionSpecのScopeと対応）
+SCOPE_KEYWORDS = {
+    "風水害": ["風水害", "水害", "洪水", "浸水", "台風", "土砂"],
+    "地震":   ["地震", "震災", "津波"],
+}
+
+
+def classify_scope(heading_path: str) -> str:
+    """見出しの階層から災害種別（風水害 / 地震 / 共通）を判定する。一番深い見出しを優先する"""
+    for title in reversed(heading_path.split(" > ")):
+        for scope, words in SCOPE_KEYWORDS.items():
+            if any(word in title for word in words):
+                return scope
+    return "共通"
+
+
+def iter_markdown_blocks(page_text: str):
+    """
+    1ページ分のMarkdownを (種類, テキスト, 見出しレベル) のブロックに分けて順に返す。
+    種類は "heading" / "table" / "list" / "text"。見出し以外のレベルは0。
+    """
+    kind, lines = None, []
+
+    def flush():
+        if lines:
+            yield kind, "\n".join(lines), 0
+
+    for line in page_text.splitlines():
+        if _FENCE_RE.match(line):          # phase1の ```markdown 囲みは除去
+            continue
+
+        heading = _HEADING_RE.match(line)
+        if heading:
+            yield from flush()
+            kind, lines = None, []
+            yield "heading", heading.group(2), len(heading.group(1))
+            continue
+
+        if not line.strip():
+            yield from flush()
+            kind, lines = None, []
+            continue
+
+        if _TABLE_RE.match(line):
+            line_kind = "table"
+        elif _LIST_RE.match(line):
+            line_kind = "list"
+        else:
+            # 表・箇条書きの直後の普通の行は、箇条書きなら継続行として扱う
+            line_kind = "list" if kind == "list" else "text"
+
+        # 種類が変わる所と、箇条書きの各項目の先頭でブロックを区切る
+        if line_kind != kind or (line_kind == "list" and _LIST_RE.match(line)):
+            yield from flush()
+            kind, lines = line_kind, []
+        lines.append(line)
+
+    yield from flush()
+
+
+def _split_table(table: str, chunk_size: int, overlap: int):
+    """大きすぎる表を行単位で分割する（各チャンクに表のヘッダー行を付け直す）"""
+    rows = table.split("\n")
+    header = rows[:2] if len(rows) > 2 and set(rows[1].replace("|", "").strip()) <= set("-: ") else rows[:1]
+    body   = rows[len(header):]
+    header_text = "\n".join(header)
+
+    piece = []
+    for row in body:
+        if len(header_text) + len(row) + 1 > chunk_size:
+            # 1行だけで予算を超える場合は固定長分割にフォールバック
+            if piece:
+                yield "\n".join(header + piece)
+                piece = []
+            yield from sliding_window(row, chunk_size, overlap)
+            continue
+        if len("\n".join(header + piece + [row])) > chunk_size and piece:
+            yield "\n".join(header + piece)
+            piece = []
+        piece.append(row)
+
+    if piece:
+        yield "\n".join(header + piece)
+
+
+def iter_markdown_chunks(text: str, chunk_size: int, overlap: int):
+    """
+    ページ→ブロックの順に読み進め、chunk_size文字以内にブロックを詰めてチャンクを返す（ストリーミング）。
+    見出しで必ず区切り、見出しの階層（例: "第2部 災害予防編 > 第1節 ..."）を heading_path に持たせる。
+    1ブロックで予算を超える場合は、表は行単位、それ以外は固定長の分割にフォールバックする。
+    """
+    headings = []   # [(レベル, 見出し)]
+
+    current_document = None
+
+    for document, page_num, page_text in split_pages(text):
+        if document != current_document:
+            headings = []   # 別ファイルに移ったら見出しの階層をリセット
+            current_document = document
+        buffer, has_body = [], False
+
+        def emit(pieces):
+            heading_path = " > ".join(title for _, title in headings)
+            return {
+                "text":         "\n".join(pieces),
+                "page_num":     page_num,
+                "document":     document,
+                "heading_path": heading_path,
+                "scope":        classify_scope(heading_path),
+            }
+
+        for kind, block, level in iter_markdown_blocks(page_text):
+            if kind == "heading":
+                # 見出しが続く場合（章→節など）は区切らずにまとめる
+                if has_body:
+                    yield emit(buffer)
+                    buffer, has_body = [], False
+                while headings and headings[-1][0] >= level:
+                    headings.pop()
+                headings.append((level, block))
+                block = "#" * level + " " + block
+
+            if len(block) > chunk_size:
+                # 直前の短い見出しなどは、分割した最初のチャンクの先頭に付ける
+                prefix = "\n".join(buffer)
+                if len(prefix) > chunk_size // 4:
+                    yield emit(buffer)
+                    prefix = ""
+                buffer, has_body = [], False
+
+                budget = chunk_size - len(prefix) - 1 if prefix else chunk_size
+                # 見出しを付けると予算が減るので、重複も予算の半分までに抑える
+                block_overlap = min(overlap, budget // 2)
+                if kind == "table":
+                    pieces = _split_table(block, budget, block_overlap)
+                else:
+                    pieces = sliding_window(block, budget, block_overlap)
+                for piece in pieces:
+                    yield emit([prefix, piece] if prefix else [piece])
+                    prefix = ""
+                continue
+
+            if buffer and len("\n".join(buffer)) + 1 + len(block) > chunk_size:
+                yield emit(buffer)
+                buffer, has_body = [], False
+            buffer.append(block)
+            has_body = has_body or kind != "heading"
+
+        if buffer:
+            yield emit(buffer)
+
+
+def split_into_chunks_markdown(text: str, chunk_size: int, overlap: int) -> list[dict]:
+    """
+    Markdownの構造（見出し・表・箇条書き）に沿ってチャンクに分割する。
+    返り値の形式は split_into_chunks と同じで、"heading_path"（見出しの階層）が追加される。
+    """
+    print(f"\n✂️  チャンク分割中（Markdown構造, 上限={chunk_size}文字, 長大ブロックの重複={overlap}文字）")
+
+    chunks = []
+    for chunk in iter_markdown_chunks(text, chunk_size, overlap):
+        chunk["id"] = f"chunk_{len(chunks):04d}"
+        chunks.append(chunk)
 
     print(f"   → 生成チャンク数: {len(chunks)} 個")
     return chunks
 
 
+def chunk_text(text: str, strategy: str = None,
+               chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> list[dict]:
+    """CHUNK_STRATEGY（"markdown" / "window"）に応じて分割方法を切り替える"""
+    strategy = strategy or CHUNK_STRATEGY
+    if strategy == "markdown":
+        return split_into_chunks_markdown(text, chunk_size, overlap)
+    if strategy == "window":
+        return split_into_chunks(text, chunk_size, overlap)
+    raise ValueError(f"未対応の分割方法です: {strategy}")
+
+
 # ===================================================
-# Step3: ChromaDBにチャンクを保存する
+# Step3: ベクトルストアにチャンクを保存する
 # ===================================================
-def build_chroma_db(chunks: list[dict]):
-    print(f"\n🔧 ChromaDB構築中...")
+def load_embed_model(backend: str = EMBED_BACKEND) -> SentenceTransformer:
+    """埋め込みモデルをロードする（初回はダウンロードが走ります）"""
+    if backend == "torch":
+        return SentenceTransformer(EMBED_MODEL)
 
-    # 埋め込みモデルをロード（初回はダウンロードが走ります）
-    print(f"   モデルロード中: {EMBED_MODEL}")
-    print(f"   （初回は数分かかる場合があります）")
-    model = SentenceTransformer(EMBED_MODEL)
+    model_kwargs = {"file_name": EMBED_ONNX_FILE} if EMBED_ONNX_FILE else None
+    return SentenceTransformer(EMBED_MODEL, backend=backend, model_kwargs=model_kwargs)
+
+
+def bucket_by_length(chunks: list[dict], model, batch_size: int) -> list[list[dict]]:
+    """
+    チャンクをトークン長順に並べ替えてバッチに分ける。
+    長さの近いチャンク同士をまとめることで、パディングの無駄を減らす。
+    """
+    texts   = [c["text"] for c in chunks]
+    lengths = [len(ids) for ids in model.tokenizer(texts, add_special_tokens=False)["input_ids"]]
+    order   = sorted(range(len(chunks)), key=lambda i: lengths[i])
+
+    return [
+        [chunks[i] for i in order[start : start + batch_size]]
+        for start in range(0, len(order), batch_size)
+    ]
+
+
+def _chunk_metadata(chunk: dict) -> dict:
+    """
+    id・本文以外の項目をそのままメタデータとして保存する。
+    ページ範囲での絞り込み用に、チャンクが載っている最後のページ（page_last）を加える
+    （重複除去でまとめたチャンクは "pages" の最大値、それ以外は page_num と同じ）
+    """
+    meta = {k: v for k, v in chunk.items() if k not in ("id", "text")}
+    pages = str(chunk.get("pages") or chunk["page_num"])
+    meta["page_last"] = max(int(p) for p in pages.split(","))
+    return meta
+
+
+def _write_worker(store, write_queue: queue.Queue, stats: dict, errors: list):
+    """書き込み専用スレッド：エンコード済みバッチをキューから取り出して保存する"""
+    while True:
+        batch = write_queue.get()
+        if batch is None:
+            break
+        if errors:
+            continue   # 失敗後はキューを空にするだけ（メインスレッドを止めないため）
+
+        t0 = time.perf_counter()
+        try:
+            store.add(**batch)
+        except Exception as e:
+            errors.append(e)
+        stats["write_sec"] += time.perf_counter() - t0
+
+
+def encode_and_store(chunks: list[dict], model, store,
+                     batch_size: int = EMBED_BATCH_SIZE,
+                     workers: int = EMBED_WORKERS) -> dict:
+    """
+    トークン長でバケット化したチャンクをエンコードし、
+    書き込みスレッドと並行してベクトルストアに保存する。
+
+    返り値: {"chunks", "total_sec", "encode_sec", "write_sec", "chunks_per_sec", "peak_memory_mb"}
+    """
+    batches = bucket_by_length(chunks, model, batch_size)
+    stats   = {"encode_sec": 0.0, "write_sec": 0.0}
+    errors  = []
+
+    # 書き込み待ちを上限付きキューにして、エンコードと保存を重ねる
+    write_queue = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+    writer = threading.Thread(target=_write_worker, args=(store, write_queue, stats, errors))
+    writer.start()
+
+    pool = model.start_multi_process_pool(["cpu"] * workers) if workers > 1 else None
+    # マルチプロセス時は各プロセスに1バッチずつ行き渡るようにまとめて渡す
+    group_size = workers if pool else 1
+
+    t_start = time.perf_counter()
+    done = 0
+    try:
+        for group_start in range(0, len(batches), group_size):
+            group = batches[group_start : group_start + group_size]
+            texts = [c["text"] for batch in group for c in batch]
+
+            # テキスト→ベクトル変換
+            t0 = time.perf_counter()
+            if pool:
+                embeddings = model.encode_multi_process(
+                    texts, pool, batch_size=batch_size, chunk_size=batch_size)
+            else:
+                embeddings = model.encode(texts, batch_size=batch_size, show_progress_bar=False)
+            stats["encode_sec"] += time.perf_counter() - t0
+
+            group_chunks = [c for batch in group for c in batch]
+            write_queue.put({
+                "ids":        [c["id"] for c in group_chunks],
+                "documents":  texts,
+                "embeddings": embeddings,
+                "metadatas":  [_chunk_metadata(c) for c in group_chunks],
+            })
+
+            done += len(group_chunks)
+            print(f"   エンコード済み: {done}/{len(chunks)} チャンク")
+            if errors:
+                break
+    finally:
+        write_queue.put(None)
+        writer.join()
+        if pool:
+            model.stop_multi_process_pool(pool)
 
-    # ChromaDBクライアントを作成（フォルダに保存）
-    client = chromadb.PersistentClient(path=CHROMA_DB_PATH)
+    if errors:
+        raise errors[0]
 
-    # コレクションが既にあれば削除して作り直す（再実行時のため）
-    existing = [c.name for c in client.list_collections()]
-    if COLLECTION_NAME in existing:
-        print(f"   既存コレクション '{COLLECTION_NAME}' を削除して再作成します")
-        client.delete_collection(COLLECTION_NAME)
+    store.flush()
+    total_sec = time.perf_counter() - t_start
 
-    collection = client.create_collection(
-        name=COLLECTION_NAME,
-        metadata={"hnsw:space": "cosine"}  # コサイン類似度で検索
-    )
+    stats.update({
+        "chunks":         len(chunks),
+        "total_sec":      total_sec,
+        "chunks_per_sec": len(chunks) / total_sec if total_sec else 0.0,
+        "peak_memory_mb": peak_memory_mb(),
+    })
+    return stats
 
-    # チャンクを100件ずつまとめてベクトル化・保存（メモリ節約）
-    batch_size = 100
-    total = len(chunks)
 
-    for batch_start in range(0, total, batch_size):
-        batch = chunks[batch_start : batch_start + batch_size]
+def build_chroma_db(chunks: list[dict], backend: str = VECTOR_BACKEND):
+    print(f"\n🔧 ベクトルストア構築中...（バックエンド: {backend}）")
 
-        ids       = [c["id"]       for c in batch]
-        texts     = [c["text"]     for c in batch]
-        metadatas = [{"page_num": c["page_num"]} for c in batch]
+    print(f"   モデルロード中: {EMBED_MODEL}（推論: {EMBED_BACKEND}, ワーカー数: {EMBED_WORKERS}）")
+    print(f"   （初回は数分かかる場合があります）")
+    model = load_embed_model()
 
-        # テキスト→ベクトル変換
-        embeddings = model.encode(texts, show_progress_bar=False).tolist()
+    # 新しいバージョンに書き込む（構築中も、公開中のインデックスはそのまま検索に使える）
+    store = create_vector_store(backend)
 
-        collection.add(
-            ids        = ids,
-            documents  = texts,
-            embeddings = embeddings,
-            metadatas  = metadatas,
-        )
+    stats = encode_and_store(chunks, model, store)
 
-        done = min(batch_start + batch_size, total)
-        print(f"   保存済み: {done}/{total} チャンク")
+    # 書き込みがすべて終わってから公開中のインデックスを切り替える
+    publish_vector_store(store, backend)
 
-    print(f"\n✅ ChromaDB構築完了！")
-    print(f"   保存先: {CHROMA_DB_PATH}")
-    print(f"   総チャンク数: {collection.count()} 件")
-    return collection
+    print(f"\n✅ ベクトルストア構築完了！")
+    print(f"   総チャンク数: {store.count()} 件")
+    print(f"   処理時間: {stats['total_sec']:.1f}秒 "
+          f"（エンコード {stats['encode_sec']:.1f}秒 / 書き込み {stats['write_sec']:.1f}秒 ※並行）")
+    print(f"   スループット: {stats['chunks_per_sec']:.1f} チャンク/秒")
+    if stats["peak_memory_mb"] is not None:
+        print(f"   ピークメモリ: {stats['peak_memory_mb']:.0f} MB（メインプロセス）")
+    return store
 
 
 # ===================================================
@@ -148,9 +467,11 @@ if __name__ == "__main__":
     text = load_text(INPUT_TEXT_FILE)
 
     # 2. チャンク分割
-    chunks = split_into_chunks(text, CHUNK_SIZE, CHUNK_OVERLAP)
+    chunks = chunk_text(text)
+    if DEDUP_ENABLED:
+        chunks = dedup_chunks(chunks)
 
-    # 3. ChromaDB構築
+    # 3. ベクトルストア構築
     build_chroma_db(chunks)
 
     print("\n🎉 フェーズ2 Step1 完了！次は検索テストを実行してください。")
\ No newline at end of file
@@ -0,0 +1,76 @@
+# phase2_compare_chunkers.py
+
+from phase2_build_rag import (
+    INPUT_TEXT_FILE, CHUNK_SIZE, CHUNK_OVERLAP, DEDUP_ENABLED,
+    load_text, chunk_text, load_embed_model, encode_and_store,
+)
+from phase2_dedup import dedup_chunks
+from perf_stats import percentile
+from phase3_answer_engine import TOP_K, retrieve_contexts, context_block
+from question_spec import load_question_spec
+from token_budget import estimate_tokens
+from vector_store import NumpyVectorStore
+
+# ===================================================
+# 設定
+# ===================================================
+STRATEGIES = ["window", "markdown"]   # 比較する分割方法
+# 取得件数・類似度での絞り込みは phase3_answer_engine の設定（TOP_K など）をそのまま使う
+
+
+def count_broken_table_rows(chunks: list[dict]) -> int:
+    """表の行が途中で切れているチャンクの数（"|" で始まり "|" で終わらない行を含む）"""
+    broken = 0
+    for c in chunks:
+        for line in c["text"].splitlines():
+            stripped = line.strip()
+            if "|" in stripped and not (stripped.startswith("|") and stripped.endswith("|")):
+                broken += 1
+                break
+    return broken
+
+
+def context_tokens(questions: list[dict], contexts: dict) -> list[int]:
+    """質問ごとに、phase3のプロンプトに入る参考情報のトークン数（見積もり）を返す"""
+    return [estimate_tokens(context_block(q, contexts[q["qid"]])) for q in questions]
+
+
+# ===================================================
+# メイン処理
+# ===================================================
+if __name__ == "__main__":
+    text      = load_text(INPUT_TEXT_FILE)
+    questions = load_question_spec()
+    model     = load_embed_model()
+
+    report = []
+    for strategy in STRATEGIES:
+        chunks = chunk_text(text, strategy, CHUNK_SIZE, CHUNK_OVERLAP)
+        if DEDUP_ENABLED:
+            chunks = dedup_chunks(chunks)
+
+        # 比較用なのでディスクには保存せずメモリ上のインデックスを使う
+        store = NumpyVectorStore(None)
+        encode_and_store(chunks, model, store)
+        # phase3と同じく上位TOP_K件を取得し、類似度で絞り込んだチャンクで数える
+        tokens = context_tokens(questions, retrieve_contexts(questions, store, model))
+
+        report.append({
+            "strategy":     strategy,
+            "chunks":       len(chunks),
+            "avg_chars":    sum(len(c["text"]) for c in chunks) / max(len(chunks), 1),
+            "broken_table": count_broken_table_rows(chunks),
+            "tokens":       tokens,
+        })
+
+    print(f"\n{'='*60}")
+    print(f"📊 分割方法の比較（上限{CHUNK_SIZE}文字, 重複{CHUNK_OVERLAP}文字, 上位{TOP_K}件から類似度で絞り込み）")
+    print(f"{'='*60}")
+    for r in report:
+        t = r["tokens"]
+        print(f"\n[{r['strategy']}]")
+        print(f"   チャンク数: {r['chunks']} 個（平均 {r['avg_chars']:.0f} 文字）")
+        print(f"   表の行が途中で切れたチャンク: {r['broken_table']} 個")
+        print(f"   1問あたり参考情報トークン（見積もり）: "
+              f"平均 {sum(t) / max(len(t), 1):.0f} / p50 {percentile(t, 50):.0f} / p95 {percentile(t, 95):.0f}")
+        print(f"   全{len(t)}問の合計: {sum(t):,} トークン")
@@ -0,0 +1,120 @@
+# phase2_dedup.py
+
+import re
+import time
+import zlib
+import unicodedata
+import numpy as np
+
+# ===================================================
+# 設定
+# ===================================================
+SHINGLE_SIZE    = 5      # 文字シングルの長さ（日本語は5文字程度が目安）
+NUM_PERM        = 128    # MinHashのハッシュ関数の数
+LSH_BANDS       = 16     # LSHのバンド数（NUM_PERM = バンド数 × 行数）
+DEDUP_THRESHOLD = 0.85   # 推定Jaccard類似度がこれ以上なら重複とみなす
+
+_PRIME = np.uint64(4294967311)   # 2^32より大きい最小の素数（ハッシュ値はcrc32の32bit）
+_rng   = np.random.default_rng(42)
+_PERM_A = _rng.integers(1, 2**32, size=NUM_PERM, dtype=np.uint64)
+_PERM_B = _rng.integers(0, 2**32, size=NUM_PERM, dtype=np.uint64)
+
+
+# ===================================================
+# MinHash署名
+# ===================================================
+def _normalize(text: str) -> str:
+    """表記ゆれ（全角/半角）と空白の違いを無視するための正規化"""
+    text = unicodedata.normalize("NFKC", text)
+    return re.sub(r"\s+", "", text)
+
+
+def _shingle_hashes(text: str) -> np.ndarray:
+    if len(text) <= SHINGLE_SIZE:
+        shingles = {text}
+    else:
+        shingles = {text[i : i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+    return np.fromiter(
+        (zlib.crc32(s.encode("utf-8")) for s in shingles),
+        dtype=np.uint64, count=len(shingles),
+    )
+
+
+def minhash_signature(text: str) -> np.ndarray:
+    """
+    文字シングルの集合からMinHash署名（NUM_PERM個の最小ハッシュ値）を作る。
+    2つの署名の一致率が、元の集合のJaccard類似度の推定値になる。
+    """
+    hashes = _shingle_hashes(text)
+    # (a*h + b) mod p は a, h < 2^32 なので uint64 に収まる
+    permuted = (np.outer(_PERM_A, hashes) + _PERM_B[:, None]) % _PRIME
+    return permuted.min(axis=1)
+
+
+# ===================================================
+# 重複除去
+# ===================================================
+def dedup_chunks(chunks: list[dict], threshold: float = DEDUP_THRESHOLD) -> list[dict]:
+    """
+    ほぼ同じ内容のチャンク（ヘッダー・フッター、目次表、定型文など）を1つにまとめる。
+    残したチャンクの "pages" に、まとめたチャンクのページ番号をすべて記録する。
+    （ChromaDBのメタデータはリスト不可のため "12,15" のようなカンマ区切り文字列）
+    重複の判定は同じ document（PDFファイル）の中だけで行う。
+    別ファイルのチャンクをまとめると、ファイルで絞り込めなくなり、根拠ページもどのファイルか分からなくなるため。
+    """
+    print(f"\n🧹 重複チャンク除去中（Jaccard≧{threshold}）")
+    t0 = time.perf_counter()
+
+    rows_per_band = NUM_PERM // LSH_BANDS
+    buckets  = [{} for _ in range(LSH_BANDS)]   # バンドごとの {(ファイル名, 署名の一部): [残したチャンクの番号, ...]}
+    exact    = {}                               # (ファイル名, 正規化テキスト) → 残したチャンクの番号
+    kept     = []
+    pages    = []
+    signatures = []
+    merged_exact = merged_near = 0
+
+    for chunk in chunks:
+        document = chunk.get("document", "")
+        norm = _normalize(chunk["text"])
+
+        # 1. 完全一致（正規化後）は署名計算なしでまとめる
+        if (document, norm) in exact:
+            pages[exact[(document, norm)]].add(chunk["page_num"])
+            merged_exact += 1
+            continue
+
+        # 2. LSHで候補を絞り、署名の一致率で近似重複を判定する
+        sig = minhash_signature(norm)
+        keys = [(document, sig[b * rows_per_band : (b + 1) * rows_per_band].tobytes())
+                for b in range(LSH_BANDS)]
+        candidates = {idx for b, key in enumerate(keys) for idx in buckets[b].get(key, ())}
+
+        duplicate_of = None
+        for idx in sorted(candidates):
+            if np.mean(signatures[idx] == sig) >= threshold:
+                duplicate_of = idx
+                break
+
+        if duplicate_of is not None:
+            pages[duplicate_of].add(chunk["page_num"])
+            merged_near += 1
+            continue
+
+        idx = len(kept)
+        kept.append(dict(chunk))
+        pages.append({chunk["page_num"]})
+        signatures.append(sig)
+        exact[(document, norm)] = idx
+        for b, key in enumerate(keys):
+            buckets[b].setdefault(key, []).append(idx)
+
+    for chunk, page_set in zip(kept, pages):
+        chunk["pages"] = ",".join(str(p) for p in sorted(page_set))
+
+    elapsed = time.perf_counter() - t0
+    removed = len(chunks) - len(kept)
+    ratio   = removed / len(chunks) if chunks else 0.0
+    print(f"   → {len(chunks)} → {len(kept)} チャンク"
+          f"（除去 {removed} 件 = {ratio:.1%}: 完全一致 {merged_exact} / 近似 {merged_near}）")
+    print(f"   → 処理時間: {elapsed:.2f}秒")
+    return kept
@@ -0,0 +1,255 @@
+# phase2_eval_search.py
+
+import io
+import os
+import csv
+import time
+import hashlib
+import itertools
+import contextlib
+import numpy as np
+from sentence_transformers import SentenceTransformer
+from phase2_build_rag import INPUT_TEXT_FILE, EMBED_MODEL, load_text, chunk_text
+from phase2_dedup import dedup_chunks
+from perf_stats import percentile
+from phase3_answer_engine import TOP_K
+from question_spec import load_question_spec, make_search_query
+from vector_store import NumpyVectorStore
+
+# ===================================================
+# 設定
+# ===================================================
+# 正解データ: 質問ごとの根拠ページ（CSV, 列: QID,pages  例: 1,"12,15"）
+GOLD_FILE    = "gold_evidence.csv"
+RESULTS_FILE = "eval_results.csv"       # 評価結果の出力先
+CACHE_DIR    = "./eval_cache"           # 埋め込みキャッシュ（設定をまたいで再利用）
+
+# パラメータの組み合わせ（すべての組み合わせを評価する）
+SWEEP = {
+    "strategy":    ["window", "markdown"],
+    "chunk_size":  [300, 400, 600],
+    "overlap":     [0, 80],
+    "dedup":       [False, True],
+    "embed_model": [EMBED_MODEL],
+}
+SORT_K   = TOP_K                 # 結果を並べる基準（phase3の取得件数 TOP_K に合わせる）
+K_VALUES = sorted({1, 3, 4, 5, 10, SORT_K})   # recall@k を計算するk（SORT_Kは必ず含める）
+
+
+# ===================================================
+# 正解データ
+# ===================================================
+def load_gold(filepath: str = GOLD_FILE) -> dict:
+    """
+    正解の根拠ページを読み込む
+    返り値: { QID(int): {12, 15} }
+    """
+    gold = {}
+    with open(filepath, "r", encoding="utf-8-sig") as f:
+        for row in csv.DictReader(f):
+            pages = {int(p) for p in row["pages"].replace(",", " ").split()}
+            if pages:
+                gold[int(row["QID"])] = pages
+    print(f"✅ 正解データ読み込み完了: {len(gold)}問")
+    return gold
+
+
+# ===================================================
+# 埋め込みキャッシュ（同じテキストは設定が変わっても再エンコードしない）
+# ===================================================
+class EmbeddingCache:
+    def __init__(self, model_name: str, cache_dir: str = CACHE_DIR):
+        self.model_name = model_name
+        self.path  = os.path.join(cache_dir, model_name.replace("/", "_") + ".npz")
+        self.model = None
+        self.vectors = {}
+        if os.path.exists(self.path):
+            saved = np.load(self.path)
+            self.vectors = dict(zip(saved["keys"].tolist(), saved["matrix"]))
+        self.dirty = False
+
+    @staticmethod
+    def _key(text: str) -> str:
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def encode(self, texts: list[str]) -> np.ndarray:
+        """キャッシュにないテキストだけをエンコードして、texts と同じ順のベクトルを返す"""
+        keys    = [self._key(t) for t in texts]
+        missing = {k: t for k, t in zip(keys, texts) if k not in self.vectors}
+        if missing:
+            if self.model is None:
+                self.model = SentenceTransformer(self.model_name)
+            new_vectors = self.model.encode(list(missing.values()), show_progress_bar=False)
+            self.vectors.update(zip(missing.keys(), new_vectors))
+            self.dirty = True
+        return np.stack([self.vectors[k] for k in keys])
+
+    def save(self):
+        if not self.dirty:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        keys = list(self.vectors)
+        # 保存中に止められても壊れないよう、一時ファイルに書いてから置き換える
+        tmp_path = self.path[: -len(".npz")] + ".tmp.npz"
+        np.savez(tmp_path, keys=np.array(keys), matrix=np.stack([self.vectors[k] for k in keys]))
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+
+# ===================================================
+# 評価指標
+# ===================================================
+def _chunk_pages(meta: dict) -> set[int]:
+    # 重複除去でまとめたチャンクは "pages" に全ページが入っている
+    pages = meta.get("pages")
+    if pages:
+        return {int(p) for p in str(pages).split(",")}
+    return {meta["page_num"]}
+
+
+def score_results(results: dict, qids: list[int], gold: dict) -> dict:
+    """
+    質問ごとの検索結果から recall@k と MRR を計算する
+    recall@k: 上位k件のチャンクが載っているページで、正解ページを何割カバーできたか
+    MRR:      正解ページを含む最初のチャンクの順位の逆数の平均
+    """
+    recall = {k: [] for k in K_VALUES}
+    rr = []
+    for qid, metas in zip(qids, results["metadatas"]):
+        expected = gold[qid]
+        page_sets = [_chunk_pages(m) for m in metas]
+
+        for k in K_VALUES:
+            found = set().union(*page_sets[:k]) if page_sets[:k] else set()
+            recall[k].append(len(expected & found) / len(expected))
+
+        rank = next((i + 1 for i, pages in enumerate(page_sets) if pages & expected), None)
+        rr.append(1 / rank if rank else 0.0)
+
+    scores = {f"recall@{k}": sum(v) / len(v) for k, v in recall.items()}
+    scores["mrr"] = sum(rr) / len(rr)
+    return scores
+
+
+# ===================================================
+# 1設定分の評価
+# ===================================================
+def evaluate_config(config: dict, text: str, queries: dict, gold: dict, cache: EmbeddingCache) -> dict:
+    # チャンク分割・重複除去（ログは多すぎるので抑制する）
+    with contextlib.redirect_stdout(io.StringIO()):
+        chunks = chunk_text(text, config["strategy"], config["chunk_size"], config["overlap"])
+        if config["dedup"]:
+            chunks = dedup_chunks(chunks)
+
+    t0 = time.perf_counter()
+    texts = [c["text"] for c in chunks]
+    store = NumpyVectorStore(None)
+    store.add(
+        ids        = [c["id"] for c in chunks],
+        documents  = texts,
+        embeddings = cache.encode(texts),
+        metadatas  = [{k: v for k, v in c.items() if k not in ("id", "text")} for c in chunks],
+    )
+    store.flush()
+    build_sec = time.perf_counter() - t0
+
+    qids = list(queries)
+    query_vectors = cache.encode([queries[qid] for qid in qids])
+    max_k = max(K_VALUES)
+
+    # 1問ずつ検索してレイテンシを記録する（クエリのエンコードはキャッシュ済みなので含まない）
+    latencies_ms = []
+    metadatas = []
+    for vec in query_vectors:
+        t0 = time.perf_counter()
+        res = store.query([vec], n_results=max_k, include=["metadatas"])
+        latencies_ms.append((time.perf_counter() - t0) * 1000)
+        metadatas.append(res["metadatas"][0])
+
+    row = dict(config)
+    row.update({
+        "chunks":         len(chunks),
+        "build_sec":      round(build_sec, 3),
+        "search_p50_ms":  round(percentile(latencies_ms, 50), 3),
+        "search_p95_ms":  round(percentile(latencies_ms, 95), 3),
+        "search_p99_ms":  round(percentile(latencies_ms, 99), 3),
+    })
+    row.update({k: round(v, 4) for k, v in score_results({"metadatas": metadatas}, qids, gold).items()})
+    return row
+
+
+def measure_encode_latency(cache: EmbeddingCache, queries: list[str]) -> list[float]:
+    """クエリ1件あたりのエンコード時間（キャッシュを使わない実測, ミリ秒）"""
+    if cache.model is None:
+        cache.model = SentenceTransformer(cache.model_name)
+    latencies_ms = []
+    for query in queries:
+        t0 = time.perf_counter()
+        cache.model.encode([query], show_progress_bar=False)
+        latencies_ms.append((time.perf_counter() - t0) * 1000)
+    return latencies_ms
+
+
+# ===================================================
+# メイン処理
+# ===================================================
+if __name__ == "__main__":
+    if not os.path.exists(GOLD_FILE):
+        print(f"❌ 正解データ {GOLD_FILE} がありません。")
+        print('   列 QID,pages のCSVを用意してください（例: 1,"12,15"）')
+        raise SystemExit(1)
+
+    text  = load_text(INPUT_TEXT_FILE)
+    gold  = load_gold()
+    questions = [q for q in load_question_spec() if q["qid"] in gold]
+    queries   = {q["qid"]: make_search_query(q) for q in questions}
+    if not queries:
+        print(f"❌ {GOLD_FILE} のQIDが質問票（QuestionSpec）のQIDと1つも一致しません。")
+        print("   QID列に質問票と同じ番号（例: 1〜105）が入っているか確認してください")
+        raise SystemExit(1)
+    print(f"   評価対象: {len(queries)}問（正解データのある問のみ）")
+
+    keys    = list(SWEEP)
+    configs = [dict(zip(keys, values)) for values in itertools.product(*SWEEP.values())]
+    # markdown分割では overlap は長大ブロックの分割にしか使わないが、比較のため同じく振る
+    print(f"\n🔁 {len(configs)} 通りの設定を評価します")
+
+    caches = {}
+    rows = []
+    t_start = time.perf_counter()
+    try:
+        for i, config in enumerate(configs):
+            if config["embed_model"] not in caches:
+                caches[config["embed_model"]] = EmbeddingCache(config["embed_model"])
+            cache = caches[config["embed_model"]]
+            row = evaluate_config(config, text, queries, gold, cache)
+            rows.append(row)
+            # 1設定ごとに保存する（途中で止めても、それまでのエンコード結果は次回使える）
+            cache.save()
+            print(f"   [{i+1}/{len(configs)}] {config} → "
+                  f"recall@{SORT_K}={row[f'recall@{SORT_K}']:.3f}, MRR={row['mrr']:.3f}, "
+                  f"チャンク数={row['chunks']}, 検索p50={row['search_p50_ms']}ms")
+    finally:
+        # 設定の途中でエラー・Ctrl+Cになった場合も、エンコード済みの分は保存する
+        for cache in caches.values():
+            cache.save()
+
+    # 埋め込みモデルごとのクエリエンコード時間
+    print(f"\n⏱️  クエリのエンコード時間（1件ずつ）")
+    for name, cache in caches.items():
+        latencies = measure_encode_latency(cache, list(queries.values()))
+        print(f"   {name}: p50={percentile(latencies, 50):.1f}ms  "
+              f"p95={percentile(latencies, 95):.1f}ms  p99={percentile(latencies, 99):.1f}ms")
+
+    rows.sort(key=lambda r: (r[f"recall@{SORT_K}"], r["mrr"]), reverse=True)
+    with open(RESULTS_FILE, "w", encoding="utf-8-sig", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+
+    print(f"\n🏆 上位5設定（recall@{SORT_K} → MRR 順）")
+    for row in rows[:5]:
+        print(f"   {row['strategy']:8s} size={row['chunk_size']:4d} overlap={row['overlap']:3d} "
+              f"dedup={str(row['dedup']):5s} recall@{SORT_K}={row[f'recall@{SORT_K}']:.3f} "
+              f"MRR={row['mrr']:.3f} チャンク数={row['chunks']}")
+    print(f"\n✅ 全{len(rows)}設定の評価完了（{time.perf_counter() - t_start:.1f}秒）→ {RESULTS_FILE}")
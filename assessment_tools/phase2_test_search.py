@@ -1,13 +1,11 @@
 # phase2_test_search.py
 
-import chromadb
 from sentence_transformers import SentenceTransformer
+from vector_store import open_vector_store
 
 # ===================================================
 # 設定（build_ragと同じ値にする）
 # ===================================================
-CHROMA_DB_PATH  = "./chroma_db"
-COLLECTION_NAME = "manual_chunks"
 EMBED_MODEL     = "paraphrase-multilingual-mpnet-base-v2"
 TOP_K           = 5   # 上位何件取得するか
 
@@ -15,15 +13,15 @@ TOP_K           = 5   # 上位何件取得するか
 # ===================================================
 # 検索関数
 # ===================================================
-def search(query: str, collection, model, top_k: int = TOP_K):
+def search(query: str, store, model, top_k: int = TOP_K):
     """
-    クエリ文字列に近いチャンクをChromaDBから検索して返す
+    クエリ文字列に近いチャンクをベクトルストアから検索して返す
     """
     # クエリをベクトル化
-    query_vector = model.encode([query]).tolist()
+    query_vector = model.encode([query])
 
-    # ChromaDBで類似チャンクを検索
-    results = collection.query(
+    # ベクトルストアで類似チャンクを検索
+    results = store.query(
         query_embeddings = query_vector,
         n_results        = top_k,
         include          = ["documents", "metadatas", "distances"]
@@ -46,7 +44,7 @@ def show_results(query: str, results: dict):
 
     for i, (doc, meta, dist) in enumerate(zip(docs, metadatas, distances)):
         similarity = 1 - dist   # コサイン距離→類似度に変換
-        print(f"\n--- 結果 {i+1} (類似度: {similarity:.3f}, ページ: {meta['page_num']}) ---")
+        print(f"\n--- 結果 {i+1} (類似度: {similarity:.3f}, ページ: {meta.get('pages', meta['page_num'])}) ---")
         print(doc[:300] + "..." if len(doc) > 300 else doc)
 
     print(f"\n{'='*60}")
@@ -56,12 +54,11 @@ def show_results(query: str, results: dict):
 # メイン処理
 # ===================================================
 if __name__ == "__main__":
-    print("ChromaDB読み込み中...")
-    client     = chromadb.PersistentClient(path=CHROMA_DB_PATH)
-    collection = client.get_collection(COLLECTION_NAME)
-    model      = SentenceTransformer(EMBED_MODEL)
+    print("ベクトルストア読み込み中...")
+    store = open_vector_store()
+    model = SentenceTransformer(EMBED_MODEL)
 
-    print(f"✅ 読み込み完了（総チャンク数: {collection.count()} 件）")
+    print(f"✅ 読み込み完了（総チャンク数: {store.count()} 件）")
     print("\n検索クエリを入力してください。終了するには 'q' を入力。\n")
 
     # ===================================================
@@ -76,7 +73,7 @@ if __name__ == "__main__":
     ]
 
     for query in test_queries:
-        results = search(query, collection, model)
+        results = search(query, store, model)
         show_results(query, results)
 
     # ===================================================
@@ -90,5 +87,5 @@ if __name__ == "__main__":
             break
         if not query:
             continue
-        results = search(query, collection, model)
+        results = search(query, store, model)
         show_results(query, results)
\ No newline at end of file
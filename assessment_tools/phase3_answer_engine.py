@@ -3,11 +3,12 @@
 import os
 import json
 import time
-import chromadb
 import google.generativeai as genai
 from sentence_transformers import SentenceTransformer
 from dotenv import load_dotenv
 from question_spec import load_question_spec, make_search_query
+from token_budget import estimate_tokens
+from vector_store import open_vector_store
 
 load_dotenv()
 genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
@@ -15,79 +16,157 @@ genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
 # ===================================================
 # 設定
 # ===================================================
-CHROMA_DB_PATH  = "./chroma_db"
-COLLECTION_NAME = "manual_chunks"
 EMBED_MODEL     = "paraphrase-multilingual-mpnet-base-v2"
-TOP_K              = 4    # 1問あたり何チャンク取得するか
-BATCH_SIZE         = 10   # 何問まとめてAPIに投げるか
+TOP_K              = 8    # 1問あたり最大何チャンク取得するか（類似度で絞り込む前の候補数）
+TOP_K_MIN          = 2    # 類似度が低くても最低限使うチャンク数
+MIN_SCORE          = 0.35 # これ未満の類似度のチャンクは使わない
+SCORE_MARGIN       = 0.15 # 1位との類似度の差がこれを超えるチャンクは使わない
+BATCH_SIZE         = 30   # 1回のAPI呼び出しに入れる最大問数（トークン予算内でもこれ以上は詰めない）
 GEMINI_MODEL       = "gemini-2.0-flash"
 BATCH_INTERVAL_SEC = 10   # バッチ間の待機秒数（API rate limit対策）
 MAX_RETRIES        = 3    # エラー時の最大リトライ回数
 RETRY_BASE_SEC     = 30   # リトライ待機の基準秒数（指数バックオフ: 30→60→120）
+CHECKPOINT_FILE    = "answers_checkpoint.json"   # バッチごとの途中結果（中断時の再開用）
+
+# モデルごとのトークン上限（入力, 出力）
+MODEL_TOKEN_LIMITS = {
+    "gemini-1.5-flash": (1_048_576, 8_192),
+    "gemini-2.0-flash": (1_048_576, 8_192),
+    "gemini-2.5-flash": (1_048_576, 65_536),
+}
+INPUT_TOKEN_BUDGET         = 60_000  # 1回の入力トークン上限（長すぎると回答精度が落ちるためモデル上限より小さくする）
+OUTPUT_BUDGET_RATIO        = 0.7     # 出力上限のうち使う割合（JSONが途中で切れないよう余裕を残す）
+ANSWER_TOKENS_PER_QUESTION = 200     # 1問あたりの回答JSONの見積もりトークン数
+LIST_ANSWER_KEYWORDS       = ["列挙", "一覧", "すべて", "全て", "リスト"]   # 回答が長くなりやすい回答指示
 
 
 # ===================================================
-# ChromaDB検索
+# ベクトル検索
 # ===================================================
-def search_chunks(query: str, collection, model, top_k: int = TOP_K) -> list[dict]:
-    """
-    クエリに近いチャンクを検索して返す
-    """
-    vector  = model.encode([query]).tolist()
-    results = collection.query(
-        query_embeddings = vector,
-        n_results        = top_k,
-        include          = ["documents", "metadatas", "distances"]
-    )
-
+def _to_chunks(docs: list, metas: list, dists: list) -> list[dict]:
     chunks = []
-    for doc, meta, dist in zip(
-        results["documents"][0],
-        results["metadatas"][0],
-        results["distances"][0],
-    ):
+    for doc, meta, dist in zip(docs, metas, dists):
         chunks.append({
             "text":     doc,
             "page_num": meta["page_num"],
+            # 重複除去でまとめたチャンクは複数ページに載っている（例: "12,15"）
+            "pages":    meta.get("pages", str(meta["page_num"])),
             "score":    round(1 - dist, 3),
         })
     return chunks
 
 
+def select_chunks(chunks: list[dict]) -> list[dict]:
+    """
+    類似度順のチャンクから、プロンプトに入れるものを選ぶ。
+    MIN_SCORE 未満や1位から SCORE_MARGIN 以上離れたものは除くが、TOP_K_MIN 件は必ず残す。
+    """
+    if not chunks:
+        return chunks
+    best = chunks[0]["score"]
+    selected = [
+        c for c in chunks
+        if c["score"] >= MIN_SCORE and best - c["score"] <= SCORE_MARGIN
+    ]
+    return selected if len(selected) >= TOP_K_MIN else chunks[:TOP_K_MIN]
+
+
+def retrieve_contexts(questions: list[dict], store, model) -> dict:
+    """
+    全質問の検索クエリをまとめてベクトル化・検索し、
+    質問ごとに類似度で絞り込んだチャンクを返す
+
+    返り値: { QID: [チャンク, ...] }
+    """
+    vectors = model.encode([make_search_query(q) for q in questions], show_progress_bar=False)
+    results = store.query(
+        query_embeddings = vectors,
+        n_results        = TOP_K,
+        include          = ["documents", "metadatas", "distances"]
+    )
+
+    contexts = {}
+    for q, docs, metas, dists in zip(
+        questions, results["documents"], results["metadatas"], results["distances"]
+    ):
+        contexts[q["qid"]] = select_chunks(_to_chunks(docs, metas, dists))
+    return contexts
+
+
 # ===================================================
-# バッチ回答生成
+# トークン予算によるバッチ分け
 # ===================================================
-def answer_batch(questions: list[dict], collection, embed_model) -> dict:
-    """
-    10問分の質問を受け取り、
-    各質問に対して検索→Gemini呼び出しで回答を返す
+def context_block(q: dict, chunks: list[dict]) -> str:
+    """1問分の参考情報（プロンプトに入れるテキスト）"""
+    refs = "\n".join([
+        f"  [ページ{c['pages']}] {c['text']}"
+        for c in chunks
+    ])
+    return f"【Q{q['qid']}の参考情報】\n{refs}"
 
-    返り値: { QID: {"answer": "...", "evidence_pages": [12, 13]} }
+
+def _question_line(q: dict) -> str:
+    return f"Q{q['qid']}: {q['text']}\n  ※回答指示: {q['output_rule']}"
+
+
+def estimate_answer_tokens(q: dict) -> int:
+    """1問の回答JSONの見積もりトークン数（列挙を求める回答指示は長めに見積もる）"""
+    rule = q.get("output_rule") or ""
+    if any(word in rule for word in LIST_ANSWER_KEYWORDS):
+        return ANSWER_TOKENS_PER_QUESTION * 2
+    return ANSWER_TOKENS_PER_QUESTION
+
+
+def token_budgets(model_name: str = GEMINI_MODEL) -> tuple[int, int]:
+    """(入力トークン予算, 出力トークン予算) を返す"""
+    input_limit, output_limit = MODEL_TOKEN_LIMITS.get(model_name, (INPUT_TOKEN_BUDGET, 8_192))
+    return min(INPUT_TOKEN_BUDGET, input_limit), int(output_limit * OUTPUT_BUDGET_RATIO)
+
+
+def plan_batches(questions: list[dict], contexts: dict) -> list[list[dict]]:
     """
+    質問ごとの入力（参考情報＋質問文）と出力（回答JSON）のトークン数を見積もり、
+    入力・出力の予算に収まるだけ詰めてバッチを作る（QIDの順番は保つ）
+    """
+    input_budget, output_budget = token_budgets()
+    fixed_tokens = estimate_tokens(build_prompt([], {}))   # ルール・出力形式などの共通部分
 
-    # 各質問の検索結果をまとめる
-    context_blocks = []
+    batches = []
+    batch, in_tokens, out_tokens = [], fixed_tokens, 0
     for q in questions:
-        query  = make_search_query(q)
-        chunks = search_chunks(query, collection, embed_model)
-
-        # 検索結果をテキストに整形
-        refs = "\n".join([
-            f"  [ページ{c['page_num']}] {c['text']}"
-            for c in chunks
-        ])
-        context_blocks.append(
-            f"【Q{q['qid']}の参考情報】\n{refs}"
-        )
+        q_in  = estimate_tokens(context_block(q, contexts.get(q["qid"], []))) \
+              + estimate_tokens(_question_line(q))
+        q_out = estimate_answer_tokens(q)
+
+        if batch and (
+            in_tokens + q_in > input_budget
+            or out_tokens + q_out > output_budget
+            or len(batch) >= BATCH_SIZE
+        ):
+            batches.append(batch)
+            batch, in_tokens, out_tokens = [], fixed_tokens, 0
+
+        batch.append(q)
+        in_tokens  += q_in
+        out_tokens += q_out
+
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+# ===================================================
+# バッチ回答生成
+# ===================================================
+def build_prompt(questions: list[dict], contexts: dict) -> str:
+    """質問と検索結果からGeminiへのプロンプトを作る"""
+    context_blocks = [context_block(q, contexts.get(q["qid"], [])) for q in questions]
 
     # 質問リストを整形
-    q_list = "\n".join([
-        f"Q{q['qid']}: {q['text']}\n  ※回答指示: {q['output_rule']}"
-        for q in questions
-    ])
+    q_list = "\n".join([_question_line(q) for q in questions])
 
     # Geminiへのプロンプト
-    prompt = f"""
+    return f"""
 あなたは地域防災計画のアセスメント担当者です。
 以下の【参考情報】は防災マニュアルから抽出した文章です。
 この情報を根拠にして、各質問に日本語で回答してください。
@@ -118,89 +197,264 @@ def answer_batch(questions: list[dict], collection, embed_model) -> dict:
 }}
 """
 
-    # Gemini API呼び出し（リトライ付き）
-    model_gemini = genai.GenerativeModel(GEMINI_MODEL)
-    response = None
-    for attempt in range(MAX_RETRIES):
+
+def _error_entry() -> dict:
+    return {"answer": "取得エラー", "evidence_pages": []}
+
+
+def answer_batch(questions: list[dict], store, embed_model, contexts: dict | None = None,
+                 on_answer=None) -> dict:
+    """
+    複数問の質問を受け取り、
+    各質問に対して検索→Gemini呼び出しで回答を返す
+    contexts（retrieve_contextsの結果）を渡した場合は検索を省略する
+    on_answer を渡すと、ストリーミング応答から1問分のJSONが完成するたびに on_answer("Q12", 回答) を呼ぶ
+
+    返り値: { QID: {"answer": "...", "evidence_pages": [12, 13]} }
+    """
+    if contexts is None:
+        contexts = retrieve_contexts(questions, store, embed_model)
+
+    _, output_limit = MODEL_TOKEN_LIMITS.get(GEMINI_MODEL, (None, 8_192))
+    model_gemini = genai.GenerativeModel(
+        GEMINI_MODEL,
+        generation_config=genai.GenerationConfig(max_output_tokens=output_limit),
+    )
+
+    # Gemini API呼び出し（ストリーミング・リトライ付き）
+    # 途中で失敗しても受け取り済みの回答は残し、リトライでは残りの質問だけを投げ直す
+    # 回答が出力上限（max_output_tokens）で途切れた場合も、届かなかった問だけを問い合わせ直す
+    result = {}
+    raw = ""
+    attempt = 0
+    while True:
+        remaining = [q for q in questions if f"Q{q['qid']}" not in result]
+        if not remaining:
+            break
+        expected = {f"Q{q['qid']}" for q in remaining}
+        prompt = build_prompt(remaining, contexts)
+        parser = StreamingAnswerParser()
+        raw = ""
+
+        # API側の失敗だけをリトライの判定に使うため、ストリームは1チャンクずつ取り出し、
+        # 回答の処理（on_answer）はtryの外で行う
+        error = None
         try:
-            response = model_gemini.generate_content(prompt)
-            break  # 成功したらループを抜ける
+            stream = iter(model_gemini.generate_content(prompt, stream=True))
         except Exception as e:
-            is_rate_limit = (
-                "429" in str(e)
-                or "ResourceExhausted" in str(type(e).__name__)
-                or "quota" in str(e).lower()
-            )
-            if is_rate_limit and attempt < MAX_RETRIES - 1:
-                wait_sec = RETRY_BASE_SEC * (2 ** attempt)  # 30→60→120秒
-                print(f"  ⚠️  レート制限エラー。{wait_sec}秒待機後にリトライ... "
-                      f"({attempt+1}/{MAX_RETRIES})")
-                time.sleep(wait_sec)
-            else:
-                print(f"  ❌ Gemini API呼び出し失敗 (attempt {attempt+1}): {e}")
-                # リトライ上限 or 予期しないエラー → 全問エラー埋め
-                return {
-                    f"Q{q['qid']}": {"answer": "取得エラー", "evidence_pages": []}
-                    for q in questions
-                }
-
-    # JSONパース
-    raw = response.text.strip()
-    # コードブロックが含まれる場合を除去
-    raw = raw.replace("```json", "").replace("```", "").strip()
-
-    try:
-        result = json.loads(raw)
-    except json.JSONDecodeError:
-        # パース失敗時は全問「取得エラー」で埋める
-        result = {
-            f"Q{q['qid']}": {"answer": "取得エラー", "evidence_pages": []}
-            for q in questions
-        }
+            error = e
+        while error is None:
+            try:
+                chunk = next(stream)
+            except StopIteration:
+                break
+            except Exception as e:
+                error = e
+                break
+            try:
+                text = chunk.text
+            except ValueError:
+                continue   # テキストを含まないチャンク（終了理由のみ等）は読み飛ばす
+            raw += text
+            for key, entry in parser.feed(text):
+                # 質問していないキー（注記など）や形式の違う値は無視する
+                if key in expected and isinstance(entry, dict):
+                    result[key] = entry
+                    if on_answer:
+                        on_answer(key, entry)
+
+        if error is None:
+            unanswered = [q for q in remaining if f"Q{q['qid']}" not in result]
+            if not unanswered:
+                break  # 全問そろったらループを抜ける
+            if len(unanswered) == len(remaining):
+                break  # 1問も取り出せなかった場合は、下で応答全体をパースし直す
+            # 見積もりより回答が長く、出力上限で途切れた（APIの失敗ではないので待機せず続ける）
+            print(f"  ↪️  回答が途中で途切れました。残り{len(unanswered)}問を再度問い合わせます")
+            continue
+
+        is_rate_limit = (
+            "429" in str(error)
+            or "ResourceExhausted" in str(type(error).__name__)
+            or "quota" in str(error).lower()
+        )
+        if is_rate_limit and attempt < MAX_RETRIES - 1:
+            wait_sec = RETRY_BASE_SEC * (2 ** attempt)  # 30→60→120秒
+            print(f"  ⚠️  レート制限エラー。{wait_sec}秒待機後にリトライ... "
+                  f"({attempt+1}/{MAX_RETRIES})")
+            time.sleep(wait_sec)
+            attempt += 1
+        else:
+            print(f"  ❌ Gemini API呼び出し失敗 (attempt {attempt+1}): {error}")
+            # リトライ上限 or 予期しないエラー → 未回答の問だけエラー埋め
+            raw = ""
+            break
+
+    # ストリーミング中に取り出せなかった問は、応答全体をJSONとしてパースし直す
+    missing = [q for q in questions if f"Q{q['qid']}" not in result]
+    if missing and raw:
+        # コードブロックが含まれる場合を除去
+        cleaned = raw.replace("```json", "").replace("```", "").strip()
+        try:
+            parsed = json.loads(cleaned)
+        except json.JSONDecodeError:
+            parsed = {}
+        for q in missing:
+            key = f"Q{q['qid']}"
+            if isinstance(parsed, dict) and isinstance(parsed.get(key), dict):
+                result[key] = parsed[key]
+                if on_answer:
+                    on_answer(key, parsed[key])
 
+    # パース失敗・API失敗の問は「取得エラー」で埋める
+    for q in questions:
+        result.setdefault(f"Q{q['qid']}", _error_entry())
     return result
 
 
+# ===================================================
+# ストリーミング応答のJSONパース
+# ===================================================
+class StreamingAnswerParser:
+    """
+    {"Q1": {...}, "Q2": {...}} 形式の応答を少しずつ受け取り、
+    1問分（トップレベルのキーと値）が完成するたびに取り出す。
+    先頭の ```json などトップレベルの { より前の文字は読み飛ばす。
+    """
+
+    def __init__(self):
+        self.buffer    = ""
+        self.pos       = 0        # 次に読む位置
+        self.depth     = 0        # 括弧の深さ（トップレベルのオブジェクト内が1）
+        self.in_string = False
+        self.escape    = False
+        self.member_start = None  # 読み途中の「"Qn": 値」の開始位置
+
+    def feed(self, text: str) -> list[tuple[str, dict]]:
+        self.buffer += text
+        completed = []
+
+        while self.pos < len(self.buffer):
+            ch = self.buffer[self.pos]
+
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                if self.depth == 1 and self.member_start is None:
+                    self.member_start = self.pos
+                self.in_string = self.depth > 0
+            elif ch in "{[":
+                self.depth += 1
+            elif ch in "}]":
+                if self.depth == 1:
+                    self._complete(completed)
+                self.depth = max(self.depth - 1, 0)
+            elif ch == "," and self.depth == 1:
+                self._complete(completed)
+
+            self.pos += 1
+
+        return completed
+
+    def _complete(self, completed: list):
+        if self.member_start is None:
+            return
+        member = self.buffer[self.member_start : self.pos]
+        self.member_start = None
+        try:
+            parsed = json.loads("{" + member + "}")
+        except json.JSONDecodeError:
+            return   # 壊れた1問分は読み飛ばす（最後に全体パースで再挑戦する）
+        completed.extend(parsed.items())
+
+
 # ===================================================
 # 105問すべてに回答する
 # ===================================================
-def answer_all(progress_callback=None) -> dict:
+def _load_checkpoint() -> dict:
+    """途中結果ファイルから回答済みの問を読み込む（取得エラーの問は除く）"""
+    if not os.path.exists(CHECKPOINT_FILE):
+        return {}
+    with open(CHECKPOINT_FILE, "r", encoding="utf-8") as f:
+        saved = json.load(f)
+    return {
+        int(qid): entry for qid, entry in saved.items()
+        if entry.get("answer") != "取得エラー"
+    }
+
+
+def _save_checkpoint(answers: dict):
+    # 書き込み途中で落ちても壊れないよう、一時ファイルに書いてから置き換える
+    tmp_path = CHECKPOINT_FILE + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(answers, f, ensure_ascii=False)
+    os.replace(tmp_path, CHECKPOINT_FILE)
+
+
+def answer_all(progress_callback=None, answer_callback=None, checkpoint_callback=None,
+               resume: bool = False) -> dict:
     """
     全105問に回答して結果を返す
 
-    progress_callback: Streamlitのプログレスバー更新用
+    progress_callback:   Streamlitのプログレスバー更新用（完了バッチ数, 総バッチ数）を受け取る。
+                         バッチ分けが決まった時点でも (0, 総バッチ数) で1回呼ぶ
+    answer_callback:     1問の回答が届くたびに (QID(int), 回答) を受け取る（結果テーブルの逐次表示用）
+    checkpoint_callback: 1バッチ終わるたびにそれまでの全回答を受け取る（途中経過のExcel保存用）
+    resume:              Trueにすると途中結果ファイル（CHECKPOINT_FILE）の回答済みの問を飛ばす
     返り値: { QID(int): {"answer": "...", "evidence_pages": [...]} }
     """
-    print("📂 ChromaDB読み込み中...")
-    client     = chromadb.PersistentClient(path=CHROMA_DB_PATH)
-    collection = client.get_collection(COLLECTION_NAME)
+    print("📂 ベクトルストア読み込み中...")
+    store       = open_vector_store()
     embed_model = SentenceTransformer(EMBED_MODEL)
 
     questions = load_question_spec()
-    all_answers = {}
-    total_batches = (len(questions) + BATCH_SIZE - 1) // BATCH_SIZE
-
-    for batch_idx in range(total_batches):
-        start = batch_idx * BATCH_SIZE
-        end   = min(start + BATCH_SIZE, len(questions))
-        batch = questions[start:end]
+    all_answers = _load_checkpoint() if resume else {}
+    if all_answers:
+        print(f"  途中結果から再開します（回答済み {len(all_answers)}問）")
+        for qid, entry in all_answers.items():
+            if answer_callback:
+                answer_callback(qid, entry)
+    pending = [q for q in questions if q["qid"] not in all_answers]
+
+    # 全問の検索をまとめて行い、トークン予算に収まるようにバッチを作る
+    contexts = retrieve_contexts(pending, store, embed_model) if pending else {}
+    batches  = plan_batches(pending, contexts)
+    total_batches = len(batches)
+    print(f"  {len(pending)}問を {total_batches} バッチに分割しました（1バッチ最大{BATCH_SIZE}問）")
+    if progress_callback:
+        progress_callback(0, total_batches)
+
+    def on_answer(key, entry):
+        # QIDを整数キーで統一して格納
+        qid = int(key.lstrip("Q"))
+        all_answers[qid] = entry
+        if answer_callback:
+            answer_callback(qid, entry)
 
+    for batch_idx, batch in enumerate(batches):
         qids = [q['qid'] for q in batch]
         print(f"  バッチ {batch_idx+1}/{total_batches}: Q{qids[0]}〜Q{qids[-1]} 処理中...")
 
-        result = answer_batch(batch, collection, embed_model)
+        result = answer_batch(batch, store, embed_model, contexts, on_answer=on_answer)
 
-        # QIDを整数キーで統一して格納
+        # ストリーミングで届かなかった問（取得エラー）も埋めておく
         for q in batch:
-            key = f"Q{q['qid']}"
-            if key in result:
-                all_answers[q['qid']] = result[key]
-            else:
-                all_answers[q['qid']] = {"answer": "取得エラー", "evidence_pages": []}
+            if q['qid'] not in all_answers:
+                on_answer(f"Q{q['qid']}", result.get(f"Q{q['qid']}", _error_entry()))
+
+        # バッチごとに途中結果を保存（中断しても完了分は残る）
+        _save_checkpoint(all_answers)
+        if checkpoint_callback:
+            checkpoint_callback(all_answers)
 
         # Streamlitプログレスバーの更新
         if progress_callback:
-            progress_callback((batch_idx + 1) / total_batches)
+            progress_callback(batch_idx + 1, total_batches)
 
         # 最後のバッチ以外は待機（API呼び出し間隔調整）
         if batch_idx < total_batches - 1:
@@ -218,12 +472,11 @@ if __name__ == "__main__":
     print("=== 回答エンジン 動作テスト ===")
     print("最初の10問だけ回答生成します...\n")
 
-    client      = chromadb.PersistentClient(path=CHROMA_DB_PATH)
-    collection  = client.get_collection(COLLECTION_NAME)
+    store       = open_vector_store()
     embed_model = SentenceTransformer(EMBED_MODEL)
 
     questions = load_question_spec()[:10]   # 最初の10問だけテスト
-    result    = answer_batch(questions, collection, embed_model)
+    result    = answer_batch(questions, store, embed_model)
 
     for qid, val in result.items():
         print(f"{qid}: {val['answer'][:60]}...")
@@ -1,7 +1,13 @@
 # phase3_excel_writer.py
 
-import shutil
+import io
+import os
+import time
+import tracemalloc
+from copy import copy
 from datetime import datetime
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 import openpyxl
 
@@ -14,36 +20,121 @@ COL_ANSWER     = 4   # D列: 回答
 COL_EVIDENCE   = 5   # E列: 根拠ページ（追記）
 
 
-def write_answers_to_excel(answers: dict, template_path: str = TEMPLATE_FILE) -> str:
+# ===================================================
+# テンプレートの解析（1テンプレートにつき1回だけ）
+# ===================================================
+class TemplateIndex:
+    """
+    テンプレートExcelを1度だけ読み込み、
+    ファイルの中身・QID→行番号の対応・根拠ページ列に付ける書式をキャッシュする。
+    出力ごとのブックはキャッシュしたバイト列から作るので、ディスクの再読込と行の走査が不要になる。
+    """
+
+    def __init__(self, template_path: str, keep_vba: bool = False):
+        self.template_path = template_path
+        self.keep_vba      = keep_vba
+        with open(template_path, "rb") as f:
+            self.data = f.read()
+
+        # 解析は常に値で読む（keep_vba=True の読み込みではQIDが数式のセルが "=ROW()-2" のような文字列になるため）
+        # keep_vba の読み込みは出力用のブックを作るとき（new_workbook）だけに使う
+        wb = openpyxl.load_workbook(io.BytesIO(self.data), data_only=True)
+        ws = wb[SHEET_NAME]
+
+        # 各行のQIDを見て行番号を控える
+        self.qid_rows = {}
+        for row_num in range(DATA_START_ROW, ws.max_row + 1):
+            qid = ws.cell(row=row_num, column=COL_QID).value
+            try:
+                self.qid_rows[int(qid)] = row_num
+            except (ValueError, TypeError):
+                continue
+
+        # 根拠ページ列（E列）を回答列（D列）と同じ書式にそろえる場合に使う（copy_styles=True）
+        self.header_style = _style_snapshot(ws.cell(row=HEADER_ROW, column=COL_ANSWER))
+        self.row_styles   = {
+            row_num: _style_snapshot(ws.cell(row=row_num, column=COL_ANSWER))
+            for row_num in self.qid_rows.values()
+        }
+
+    def new_workbook(self):
+        """
+        キャッシュしたテンプレートから新しいブックを作る。
+        keep_vba=True のときはマクロと数式をそのまま残し、それ以外は値のみ（従来どおり）。
+        """
+        return openpyxl.load_workbook(
+            io.BytesIO(self.data),
+            keep_vba  = self.keep_vba,
+            data_only = not self.keep_vba,
+        )
+
+
+def _style_snapshot(cell) -> dict:
+    return {
+        "font":          copy(cell.font),
+        "border":        copy(cell.border),
+        "fill":          copy(cell.fill),
+        "alignment":     copy(cell.alignment),
+        "number_format": cell.number_format,
+    }
+
+
+def _apply_style(cell, style: dict):
+    # テンプレート側でE列に書式が設定済みならそちらを優先する
+    if cell.has_style:
+        return
+    for name, value in style.items():
+        setattr(cell, name, copy(value))
+
+
+@lru_cache(maxsize=8)
+def _cached_index(abs_path: str, mtime: float, keep_vba: bool) -> TemplateIndex:
+    return TemplateIndex(abs_path, keep_vba)
+
+
+def load_template_index(template_path: str = TEMPLATE_FILE, keep_vba: bool = False) -> TemplateIndex:
+    """テンプレートの解析結果を返す（ファイルが更新されていなければキャッシュを使う）"""
+    abs_path = os.path.abspath(template_path)
+    return _cached_index(abs_path, os.path.getmtime(abs_path), keep_vba)
+
+
+# ===================================================
+# 書き込み
+# ===================================================
+def default_output_path(keep_vba: bool = False) -> str:
+    """日付付きの出力ファイル名（例: output_answered_20250224.xlsx）"""
+    date_str = datetime.now().strftime("%Y%m%d")
+    return f"output_answered_{date_str}.{'xlsm' if keep_vba else 'xlsx'}"
+
+
+def write_answers_to_excel(answers: dict, template_path: str = TEMPLATE_FILE,
+                           output_path: str | None = None, keep_vba: bool = False,
+                           copy_styles: bool = False) -> str:
     """
     回答辞書をExcelテンプレートに書き込み、出力ファイルパスを返す。
 
     Args:
         answers: { qid(int): {"answer": str, "evidence_pages": list[int]} }
         template_path: テンプレートExcelのパス（.xlsm）
+        output_path: 出力先（省略時は output_answered_YYYYMMDD.xlsx）
+        keep_vba: Trueにするとテンプレートのマクロ・数式を残して .xlsm で出力する
+        copy_styles: Trueにすると根拠ページ列（E列）に回答列（D列）と同じ書式を付ける
 
     Returns:
         出力ファイルのパス文字列（例: output_answered_20250224.xlsx）
     """
-    # テンプレートを読み込む（VBAマクロは保持しない。出力は.xlsx）
-    wb = openpyxl.load_workbook(template_path, keep_vba=False, data_only=True)
+    index = load_template_index(template_path, keep_vba)
+    wb = index.new_workbook()
     ws = wb[SHEET_NAME]
 
     # E列にヘッダーを追記
-    ws.cell(row=HEADER_ROW, column=COL_EVIDENCE).value = "根拠ページ"
-
-    # 各行のQIDを見て回答を書き込む
-    for row_num in range(DATA_START_ROW, ws.max_row + 1):
-        qid_cell = ws.cell(row=row_num, column=COL_QID)
-        qid = qid_cell.value
-        if qid is None:
-            continue
-
-        try:
-            qid_int = int(qid)
-        except (ValueError, TypeError):
-            continue
+    header = ws.cell(row=HEADER_ROW, column=COL_EVIDENCE)
+    header.value = "根拠ページ"
+    if copy_styles:
+        _apply_style(header, index.header_style)
 
+    # キャッシュしたQID→行番号を使って回答を書き込む
+    for qid_int, row_num in index.qid_rows.items():
         if qid_int not in answers:
             continue
 
@@ -55,21 +146,101 @@ def write_answers_to_excel(answers: dict, template_path: str = TEMPLATE_FILE) ->
         ws.cell(row=row_num, column=COL_ANSWER).value = answer_text
 
         # E列: 根拠ページ（カンマ区切り、空の場合は空文字）
+        evidence_cell = ws.cell(row=row_num, column=COL_EVIDENCE)
         if evidence_pages:
             pages_str = ", ".join(str(p) for p in evidence_pages)
-            ws.cell(row=row_num, column=COL_EVIDENCE).value = f"p.{pages_str}"
+            evidence_cell.value = f"p.{pages_str}"
         else:
-            ws.cell(row=row_num, column=COL_EVIDENCE).value = ""
+            evidence_cell.value = ""
+        if copy_styles:
+            _apply_style(evidence_cell, index.row_styles[row_num])
 
-    # 出力ファイル名（日付付き）
-    date_str    = datetime.now().strftime("%Y%m%d")
-    output_path = f"output_answered_{date_str}.xlsx"
+    # マクロを残す場合は拡張子を .xlsm にそろえる（.xlsx のままだとExcelで開けない）
+    if output_path is None:
+        output_path = default_output_path(keep_vba)
+    elif keep_vba:
+        output_path = str(Path(output_path).with_suffix(".xlsm"))
 
     wb.save(output_path)
     print(f"✅ Excel書き込み完了: {output_path}  ({len(answers)}問)")
     return output_path
 
 
+# ===================================================
+# 一括書き込み（複数の計画・複数テンプレート）
+# ===================================================
+def _write(job: dict) -> str:
+    return write_answers_to_excel(
+        job["answers"],
+        template_path = job.get("template_path", TEMPLATE_FILE),
+        output_path   = job["output_path"],
+        keep_vba      = job.get("keep_vba", False),
+        copy_styles   = job.get("copy_styles", False),
+    )
+
+
+def _write_job(job: dict, measure_memory: bool = False) -> dict:
+    """
+    1ブック分を書き込み、処理時間を返す。
+    measure_memory=True のときは、時間の計測とは別にもう1回書き込んでピークメモリ（Pythonの確保分）を測る
+    （tracemallocを動かしたままだと処理時間が大きく伸びるため）
+    """
+    t0 = time.perf_counter()
+    output_path = _write(job)
+    seconds = time.perf_counter() - t0
+
+    peak_mb = None
+    if measure_memory:
+        # 呼び出し元がすでにトレース中なら止めずに、その時点からの増分を測る
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        base, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        try:
+            _write(job)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            if started:
+                tracemalloc.stop()
+        peak_mb = (peak - base) / (1024 * 1024)
+
+    return {
+        "output_path":    output_path,
+        "seconds":        seconds,
+        "peak_memory_mb": peak_mb,
+    }
+
+
+def write_answers_bulk(jobs: list[dict], workers: int = 1, measure_memory: bool = False) -> list[dict]:
+    """
+    複数の回答辞書をまとめてExcelに書き出す。
+    テンプレートはプロセスごとに1回だけ解析し、以降はキャッシュを使う。
+
+    Args:
+        jobs: [{"answers": dict, "output_path": str, "template_path": str（省略可）,
+                "keep_vba": bool（省略可）, "copy_styles": bool（省略可）}, ...]
+        workers: 2以上で複数プロセスに分けて並列に書き込む
+        measure_memory: Trueにするとブックごとのピークメモリも測る（計測用に1回余分に書き込む）
+
+    Returns:
+        ジョブごとの {"output_path", "seconds", "peak_memory_mb"} のリスト（jobsと同じ順）
+    """
+    t0 = time.perf_counter()
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            stats = list(pool.map(_write_job, jobs, [measure_memory] * len(jobs)))
+    else:
+        stats = [_write_job(job, measure_memory) for job in jobs]
+    total = time.perf_counter() - t0
+
+    print(f"\n📊 一括書き込み: {len(jobs)}ブック / {total:.2f}秒（ワーカー数: {workers}）")
+    for s in stats:
+        memory = f", ピークメモリ {s['peak_memory_mb']:.1f} MB" if s["peak_memory_mb"] is not None else ""
+        print(f"   {s['output_path']}: {s['seconds']:.3f}秒{memory}")
+    return stats
+
+
 # ===================================================
 # 動作確認（単体テスト用）
 # ===================================================
@@ -84,3 +255,10 @@ if __name__ == "__main__":
     }
     path = write_answers_to_excel(dummy_answers)
     print(f"出力先: {path}")
+
+    # 一括書き込みテスト（2回目以降はテンプレートの解析を省略）
+    jobs = [
+        {"answers": dummy_answers, "output_path": f"output_bulk_test_{n}.xlsx"}
+        for n in range(5)
+    ]
+    write_answers_bulk(jobs, measure_memory=True)
@@ -0,0 +1,46 @@
+# search_client.py
+
+import json
+import urllib.request
+
+# ===================================================
+# 設定（search_service.py と同じ値にする）
+# ===================================================
+SERVICE_URL = "http://127.0.0.1:8765"
+TIMEOUT_SEC = 30
+
+
+def search(queries: str | list[str], top_k: int = 5, filters: dict | None = None,
+           url: str = SERVICE_URL) -> list[list[dict]]:
+    """
+    常駐中の検索サービスに問い合わせ、クエリごとの検索結果を返す。
+    モデルやインデックスを読み込まないので、他のツールからも軽く呼べる。
+
+    filters: {"document": "本編.pdf", "page_min": 1, "page_max": 50, "scope": "地震"}（すべて省略可）
+    返り値:  [[{"id", "text", "score", "page_num", ...}, ...], ...]（クエリと同じ順）
+    """
+    if isinstance(queries, str):
+        queries = [queries]
+    body = json.dumps(
+        {"queries": queries, "top_k": top_k, "filters": filters or {}},
+        ensure_ascii=False,
+    ).encode("utf-8")
+    request = urllib.request.Request(
+        f"{url}/search",
+        data    = body,
+        headers = {"Content-Type": "application/json; charset=utf-8"},
+    )
+    with urllib.request.urlopen(request, timeout=TIMEOUT_SEC) as response:
+        return json.loads(response.read())["results"]
+
+
+def get_stats(url: str = SERVICE_URL) -> dict:
+    """サービスの処理件数・平均バッチサイズを返す"""
+    with urllib.request.urlopen(f"{url}/stats", timeout=TIMEOUT_SEC) as response:
+        return json.loads(response.read())
+
+
+if __name__ == "__main__":
+    # 動作確認（search_service.py を起動しておくこと）
+    for hit in search("本部員 任命 災害対策本部 構成")[0]:
+        print(f"[{hit['score']:.3f}] ページ{hit['page_num']}: {hit['text'][:60]}...")
@@ -0,0 +1,66 @@
+# search_loadgen.py
+
+import time
+import threading
+from perf_stats import percentile, latency_summary
+from question_spec import load_question_spec, make_search_query
+from search_client import SERVICE_URL, search, get_stats
+
+# ===================================================
+# 設定
+# ===================================================
+CONCURRENCY       = 8      # 同時に問い合わせるクライアント数
+DURATION_SEC      = 20     # 計測時間
+QUERIES_PER_CALL  = 1      # 1リクエストに入れるクエリ数（2以上で一括検索を計測）
+TOP_K             = 5
+FILTERS           = None   # 例: {"scope": "地震"}
+
+
+def _client(queries: list[str], offset: int, stop_at: float, latencies_ms: list, errors: list):
+    """1クライアント分：時間いっぱいまでリクエストを送り続ける"""
+    i = offset
+    while time.perf_counter() < stop_at:
+        batch = [queries[(i + j) % len(queries)] for j in range(QUERIES_PER_CALL)]
+        i += QUERIES_PER_CALL
+        t0 = time.perf_counter()
+        try:
+            search(batch, top_k=TOP_K, filters=FILTERS)
+        except Exception as e:
+            errors.append(e)
+            continue
+        latencies_ms.append((time.perf_counter() - t0) * 1000)
+
+
+# ===================================================
+# メイン処理
+# ===================================================
+if __name__ == "__main__":
+    queries = [make_search_query(q) for q in load_question_spec()]
+    print(f"🚦 負荷試験開始: {SERVICE_URL}  同時接続 {CONCURRENCY} / {DURATION_SEC}秒 / "
+          f"1リクエスト {QUERIES_PER_CALL}クエリ")
+
+    before = get_stats()
+    latencies_ms, errors = [], []
+    stop_at = time.perf_counter() + DURATION_SEC
+    threads = [
+        threading.Thread(target=_client, args=(queries, n * 7, stop_at, latencies_ms, errors))
+        for n in range(CONCURRENCY)
+    ]
+    t_start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - t_start
+    after = get_stats()
+
+    batches = after["batches"] - before["batches"]
+    served  = after["queries"] - before["queries"]
+    print(f"\n{'='*60}")
+    print(f"   リクエスト数: {len(latencies_ms)}（エラー {len(errors)}）")
+    print(f"   QPS: {len(latencies_ms) / elapsed:.1f} リクエスト/秒, "
+          f"{len(latencies_ms) * QUERIES_PER_CALL / elapsed:.1f} クエリ/秒")
+    print(f"   レイテンシ: {latency_summary(latencies_ms)}  max={percentile(latencies_ms, 100):.2f}ms")
+    print(f"   サービス側の平均バッチサイズ: {served / batches if batches else 0:.1f} クエリ/バッチ")
+    if errors:
+        print(f"   最初のエラー: {errors[0]}")
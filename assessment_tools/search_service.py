@@ -0,0 +1,258 @@
+# search_service.py
+
+import json
+import time
+import queue
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from sentence_transformers import SentenceTransformer
+from vector_store import VECTOR_BACKEND, open_vector_store, index_version, validate_filters
+
+# ===================================================
+# 設定
+# ===================================================
+HOST             = "127.0.0.1"   # ローカルからのみ受け付ける
+PORT             = 8765
+EMBED_MODEL      = "paraphrase-multilingual-mpnet-base-v2"
+DEFAULT_TOP_K    = 5
+MAX_TOP_K        = 50
+MAX_BATCH        = 64     # 1回のエンコード・検索にまとめる最大クエリ数
+BATCH_WAIT_MS    = 5      # 最初のリクエストが来てから、後続をまとめるために待つ時間
+RELOAD_CHECK_SEC = 5      # インデックスの切り替え（Step2の再構築完了）を確認する間隔
+
+
+# ===================================================
+# 検索サービス本体（モデルとインデックスを常駐させる）
+# ===================================================
+class _Pending:
+    """処理待ちの1クエリ（結果が入ったら done をセットする）"""
+
+    def __init__(self, query: str, top_k: int, filters: dict | None):
+        self.query   = query
+        self.top_k   = top_k
+        self.filters = filters or {}
+        self.result  = None
+        self.error   = None
+        self.done    = threading.Event()
+
+
+class SearchService:
+    """
+    埋め込みモデルとベクトルストアを読み込んだまま保持し、
+    同時に届いたクエリをまとめて1回のエンコード・検索で処理する（マイクロバッチ）。
+    再構築が完了して公開中のインデックスが切り替わったら、自動で読み込み直す。
+    """
+
+    def __init__(self, backend: str = VECTOR_BACKEND):
+        self.backend = backend
+        print(f"📂 モデル読み込み中: {EMBED_MODEL}")
+        self.model = SentenceTransformer(EMBED_MODEL)
+        self.store = None
+        self.version = None
+        self.reload()
+
+        self.pending = queue.Queue()
+        self.stats = {"requests": 0, "queries": 0, "batches": 0}
+        self._stats_lock = threading.Lock()
+        threading.Thread(target=self._batch_loop, daemon=True).start()
+        threading.Thread(target=self._watch_loop, daemon=True).start()
+
+    # ---------- インデックスの読み込み ----------
+    def reload(self):
+        version = index_version(self.backend)
+        store   = open_vector_store(self.backend)
+        # 参照の差し替えだけなので、処理中のバッチは古いインデックスのまま安全に終わる
+        # （古いバージョンは次の再構築の開始時まで削除されない）
+        self.store, self.version = store, version
+        print(f"✅ インデックス読み込み完了（{self.backend}, バージョン {version or '従来形式'}, {store.count()} 件）")
+
+    def _watch_loop(self):
+        # 再構築中のファイル更新ではなく、完了時に書き換わるバージョンだけを見る
+        while True:
+            time.sleep(RELOAD_CHECK_SEC)
+            try:
+                version = index_version(self.backend)
+                if version is not None and version != self.version:
+                    print("🔄 新しいインデックスが公開されました。読み込み直します...")
+                    self.reload()
+            except Exception as e:
+                # 読めない場合は今のインデックスのまま続け、次の確認時に再挑戦する
+                print(f"  ⚠️  インデックスの再読み込みに失敗: {e}")
+
+    def check_filters(self, filters) -> dict:
+        """絞り込み条件を確認する（不正ならValueError）"""
+        filters = validate_filters(filters)
+        # バージョン管理の導入前に構築したインデックスのチャンクには document / scope がない
+        missing = [key for key in ("document", "scope") if key in filters]
+        if missing and self.version is None:
+            raise ValueError(f"このインデックスは {', '.join(missing)} で絞り込めません（Step2でRAGを再構築してください）")
+        return filters
+
+    # ---------- 検索 ----------
+    def search(self, queries: list[str], top_k: int = DEFAULT_TOP_K,
+               filters: dict | None = None) -> list[list[dict]]:
+        """クエリごとの検索結果を返す（他のリクエストとまとめて処理される）"""
+        items = [_Pending(q, top_k, filters) for q in queries]
+        for item in items:
+            self.pending.put(item)
+        for item in items:
+            item.done.wait()
+            if item.error:
+                raise item.error
+
+        with self._stats_lock:
+            self.stats["requests"] += 1
+        return [item.result for item in items]
+
+    def _batch_loop(self):
+        while True:
+            # 最初の1件が来るまで待ち、その後 BATCH_WAIT_MS だけ後続を集める
+            batch = [self.pending.get()]
+            deadline = time.perf_counter() + BATCH_WAIT_MS / 1000
+            while len(batch) < MAX_BATCH:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                self._run_batch(batch)
+            except Exception as e:
+                # エンコード自体の失敗はバッチ全体のエラーにする（検索の失敗は _run_batch 内で条件ごとに扱う）
+                for item in batch:
+                    if item.result is None and item.error is None:
+                        item.error = e
+            finally:
+                for item in batch:
+                    item.done.set()
+
+    def _run_batch(self, batch: list[_Pending]):
+        store = self.store
+        vectors = self.model.encode([item.query for item in batch], show_progress_bar=False)
+
+        # 絞り込み条件が同じクエリ同士を1回の検索にまとめる
+        groups = {}
+        for i, item in enumerate(batch):
+            key = json.dumps(item.filters, sort_keys=True, ensure_ascii=False)
+            groups.setdefault(key, []).append(i)
+
+        for indices in groups.values():
+            # 1つの条件で失敗しても、他の条件のクエリには結果を返す
+            try:
+                filters = batch[indices[0]].filters
+                top_k   = max(batch[i].top_k for i in indices)
+                results = store.query(
+                    query_embeddings = vectors[indices],
+                    n_results        = top_k,
+                    include          = ["documents", "metadatas", "distances"],
+                    filters          = filters,
+                )
+                for row, i in enumerate(indices):
+                    hits = [
+                        dict(meta, id=id_, text=doc, score=round(1 - dist, 4))
+                        for id_, doc, meta, dist in zip(
+                            results["ids"][row], results["documents"][row],
+                            results["metadatas"][row], results["distances"][row],
+                        )
+                    ]
+                    batch[i].result = hits[: batch[i].top_k]
+            except Exception as e:
+                for i in indices:
+                    batch[i].result, batch[i].error = None, e
+
+        with self._stats_lock:
+            self.stats["queries"] += len(batch)
+            self.stats["batches"] += 1
+
+
+# ===================================================
+# HTTP API
+# ===================================================
+#   GET  /health  → {"status": "ok", "backend": ..., "version": 公開中のバージョン, "chunks": 件数}
+#   GET  /stats   → リクエスト数・クエリ数・平均バッチサイズ
+#   POST /search  → {"query": "..."} または {"queries": ["...", ...]}
+#                   任意: "top_k": 5, "filters": {"document": "...", "page_min": 1, "page_max": 50, "scope": "地震"}
+#                   返り値: {"results": [[{"id", "text", "score", "page_num", ...}, ...], ...]}
+class _Handler(BaseHTTPRequestHandler):
+    service: SearchService = None
+
+    def _send_json(self, status: int, body: dict):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, {
+                "status":  "ok",
+                "backend": self.service.backend,
+                "version": self.service.version,
+                "chunks":  self.service.store.count(),
+            })
+        elif self.path == "/stats":
+            stats = dict(self.service.stats)
+            stats["avg_batch_size"] = stats["queries"] / stats["batches"] if stats["batches"] else 0.0
+            self._send_json(200, stats)
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path != "/search":
+            self._send_json(404, {"error": "not found"})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body   = json.loads(self.rfile.read(length) or b"{}")
+            queries = body["queries"] if "queries" in body else [body["query"]]
+            if not isinstance(queries, list):
+                # 文字列のままだと1文字ずつのクエリとして扱われてしまう
+                raise ValueError("queries は文字列のリストで指定してください")
+            top_k   = int(body.get("top_k", DEFAULT_TOP_K))
+            filters = self.service.check_filters(body.get("filters"))
+            if not queries or not all(isinstance(q, str) and q for q in queries):
+                raise ValueError("query/queries には空でない文字列を指定してください")
+            if not 1 <= top_k <= MAX_TOP_K:
+                raise ValueError(f"top_k は 1〜{MAX_TOP_K} で指定してください")
+        except KeyError:
+            self._send_json(400, {"error": "query または queries が必要です"})
+            return
+        except (ValueError, TypeError) as e:
+            self._send_json(400, {"error": str(e)})
+            return
+
+        try:
+            results = self.service.search(queries, top_k, filters)
+        except Exception as e:
+            self._send_json(500, {"error": str(e)})
+            return
+        self._send_json(200, {"results": results})
+
+    def log_message(self, format, *args):
+        pass   # リクエストごとのログは出さない（負荷試験時に遅くなるため）
+
+
+def serve(host: str = HOST, port: int = PORT, backend: str = VECTOR_BACKEND):
+    _Handler.service = SearchService(backend)
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    print(f"🚀 検索サービス起動: http://{host}:{port}  （Ctrl+Cで終了）")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n終了します。")
+    finally:
+        server.server_close()
+
+
+# ===================================================
+# メイン処理
+# ===================================================
+if __name__ == "__main__":
+    serve()
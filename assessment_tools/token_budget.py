@@ -0,0 +1,18 @@
+# token_budget.py
+
+# ===================================================
+# トークン数の見積もり
+# ===================================================
+# Geminiの正確なトークン数は count_tokens API で取れるが、1回ごとに通信が必要なため、
+# バッチ計画や比較には文字数からの見積もりを使う（少し多めに見積もる設定）。
+CHARS_PER_TOKEN_JA    = 1.2   # 日本語（全角文字）は1トークンあたり約1〜2文字
+CHARS_PER_TOKEN_ASCII = 4.0   # 英数字・記号は1トークンあたり約4文字
+
+
+def estimate_tokens(text: str) -> int:
+    """テキストのおおよそのトークン数を返す"""
+    if not text:
+        return 0
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    other_chars = len(text) - ascii_chars
+    return int(other_chars / CHARS_PER_TOKEN_JA + ascii_chars / CHARS_PER_TOKEN_ASCII) + 1
@@ -0,0 +1,468 @@
+# vector_store.py
+
+import os
+import json
+import shutil
+from abc import ABC, abstractmethod
+from datetime import datetime
+import numpy as np
+
+# ===================================================
+# 設定（build_rag / test_search / answer_engine で共通）
+# ===================================================
+VECTOR_BACKEND  = "chroma"            # "chroma" または "numpy"
+CHROMA_DB_PATH  = "./chroma_db"       # ChromaDBの保存先フォルダ
+NUMPY_DB_PATH   = "./vector_index"    # NumPyインデックスの保存先フォルダ
+COLLECTION_NAME = "manual_chunks"     # DB内のコレクション名（テーブル名のようなもの）
+
+NUMPY_DTYPE     = "float16"           # "float16" または "int8"（int8は行ごとにスケール量子化）
+QUERY_BLOCK     = 8192                # 内積計算を何行ずつ行うか（メモリ節約）
+
+# NumPyインデックスのファイル名
+_EMB_FILE   = "embeddings.npy"
+_SCALE_FILE = "scales.npy"
+_META_FILE  = "meta.json"
+
+# 公開中（検索に使う）インデックスのバージョンを記録するファイル（各バックエンドの保存先フォルダ直下）
+# 再構築は新しいバージョンに書き込み、完了したらこのファイルを書き換えて切り替える
+_CURRENT_FILE = "current.json"
+
+
+# ===================================================
+# 共通インターフェース
+# ===================================================
+class VectorStore(ABC):
+    """
+    ベクトルストアの共通インターフェース。
+    query() の返り値は ChromaDB と同じ形式
+    {"ids", "documents", "metadatas", "distances"}（各要素はクエリごとのリスト）にそろえる。
+    distances はコサイン距離（1 - 類似度）。
+    filters はメタデータでの絞り込み（matches_filters を参照）で、全クエリに共通で適用する。
+    """
+
+    @abstractmethod
+    def add(self, ids: list[str], documents: list[str], embeddings, metadatas: list[dict]):
+        ...
+
+    @abstractmethod
+    def query(self, query_embeddings, n_results: int, include: list[str] | None = None,
+              filters: dict | None = None) -> dict:
+        ...
+
+    @abstractmethod
+    def count(self) -> int:
+        ...
+
+    def flush(self):
+        """書き込みを確定する（必要なバックエンドのみ）"""
+        pass
+
+
+# ===================================================
+# ChromaDBバックエンド
+# ===================================================
+class ChromaVectorStore(VectorStore):
+    def __init__(self, collection):
+        self.collection = collection
+
+    @classmethod
+    def create(cls, path: str = CHROMA_DB_PATH, name: str = COLLECTION_NAME):
+        import chromadb
+        client = chromadb.PersistentClient(path=path)
+
+        # コレクションが既にあれば削除して作り直す（再実行時のため）
+        existing = [c.name for c in client.list_collections()]
+        if name in existing:
+            print(f"   既存コレクション '{name}' を削除して再作成します")
+            client.delete_collection(name)
+
+        collection = client.create_collection(
+            name=name,
+            metadata={"hnsw:space": "cosine"}  # コサイン類似度で検索
+        )
+        return cls(collection)
+
+    @classmethod
+    def open(cls, path: str = CHROMA_DB_PATH, name: str | None = None):
+        """name省略時は公開中のバージョンのコレクションを開く"""
+        import chromadb
+        client = chromadb.PersistentClient(path=path)
+        if name is None:
+            name = _chroma_collection_name(_read_current_version(path))
+        return cls(client.get_collection(name))
+
+    def add(self, ids, documents, embeddings, metadatas):
+        if isinstance(embeddings, np.ndarray):
+            embeddings = embeddings.tolist()
+        self.collection.add(
+            ids        = ids,
+            documents  = documents,
+            embeddings = embeddings,
+            metadatas  = metadatas,
+        )
+
+    def query(self, query_embeddings, n_results, include=None, filters=None):
+        if isinstance(query_embeddings, np.ndarray):
+            query_embeddings = query_embeddings.tolist()
+        return self.collection.query(
+            query_embeddings = query_embeddings,
+            n_results        = n_results,
+            include          = include or ["documents", "metadatas", "distances"],
+            where            = _to_chroma_where(filters),
+        )
+
+    def count(self):
+        return self.collection.count()
+
+
+# ===================================================
+# NumPyバックエンド（メモリマップ + 行列積で全件検索）
+# ===================================================
+class NumpyVectorStore(VectorStore):
+    """
+    正規化済み埋め込みを float16 / int8 の行列として保存し、
+    検索は行列積で全件スコアを計算して上位k件を返す。
+    数千〜数万チャンク規模ならHNSWより起動が速く、依存も軽い。
+    path=None の場合はディスクに保存せずメモリ上だけで使う。
+    """
+
+    def __init__(self, path: str | None = None, dtype: str = NUMPY_DTYPE):
+        self.path   = path
+        self.dtype  = dtype
+        self.ids:       list[str]  = []
+        self.documents: list[str]  = []
+        self.metadatas: list[dict] = []
+        self.matrix = None   # (件数, 次元) の float16 / int8
+        self.scales = None   # int8のときの行ごとのスケール（float32）
+        self._pending: list[np.ndarray] = []
+
+    @classmethod
+    def create(cls, path: str | None = NUMPY_DB_PATH, dtype: str = NUMPY_DTYPE):
+        if path and os.path.exists(path):
+            print(f"   既存インデックス '{path}' を削除して再作成します")
+            shutil.rmtree(path)
+        return cls(path, dtype)
+
+    @classmethod
+    def open(cls, path: str = NUMPY_DB_PATH):
+        """path に公開中のバージョンがあればそのフォルダを、なければ path 直下（従来形式）を開く"""
+        version = _read_current_version(path)
+        if version:
+            path = os.path.join(path, version)
+        with open(os.path.join(path, _META_FILE), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+
+        store = cls(path, meta["dtype"])
+        store.ids       = meta["ids"]
+        store.documents = meta["documents"]
+        store.metadatas = meta["metadatas"]
+        store.matrix    = np.load(os.path.join(path, _EMB_FILE), mmap_mode="r")
+        if store.dtype == "int8":
+            store.scales = np.load(os.path.join(path, _SCALE_FILE))
+        return store
+
+    def add(self, ids, documents, embeddings, metadatas):
+        vectors = _normalize(np.asarray(embeddings, dtype=np.float32))
+        self._pending.append(vectors)
+        self.ids.extend(ids)
+        self.documents.extend(documents)
+        self.metadatas.extend(metadatas)
+
+    def flush(self):
+        """追加済みのベクトルを行列にまとめ、pathがあればディスクに保存する"""
+        if self._pending:
+            vectors = np.concatenate(self._pending)
+            self._pending = []
+            matrix, scales = _quantize(vectors, self.dtype)
+            if self.matrix is not None:
+                matrix = np.concatenate([np.asarray(self.matrix), matrix])
+                if scales is not None:
+                    scales = np.concatenate([self.scales, scales])
+            self.matrix, self.scales = matrix, scales
+
+        if self.path and self.matrix is not None:
+            self._save()
+
+    def _save(self):
+        # 一時フォルダに書いてから差し替える（書き込み途中のインデックスを読ませない）
+        tmp_path = self.path + ".tmp"
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+
+        np.save(os.path.join(tmp_path, _EMB_FILE), self.matrix)
+        if self.scales is not None:
+            np.save(os.path.join(tmp_path, _SCALE_FILE), self.scales)
+        with open(os.path.join(tmp_path, _META_FILE), "w", encoding="utf-8") as f:
+            json.dump({
+                "dtype":     self.dtype,
+                "ids":       self.ids,
+                "documents": self.documents,
+                "metadatas": self.metadatas,
+            }, f, ensure_ascii=False)
+
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.replace(tmp_path, self.path)
+
+    def query(self, query_embeddings, n_results, include=None, filters=None):
+        if self._pending:
+            self.flush()
+
+        include = include or ["documents", "metadatas", "distances"]
+        queries = _normalize(np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32)))
+        scores  = self.scores(queries)
+
+        # 条件に合わないチャンクは選ばれないようにスコアを -inf にする
+        if filters:
+            mask = np.fromiter((matches_filters(m, filters) for m in self.metadatas),
+                               dtype=bool, count=len(self.metadatas))
+            scores[:, ~mask] = -np.inf
+            k = min(n_results, int(mask.sum()))
+        else:
+            k = min(n_results, scores.shape[1])
+        if k == 0:
+            empty = [[] for _ in range(len(queries))]
+            return {key: empty for key in ["ids"] + list(include)}
+
+        # 上位k件だけ部分ソートしてから並べ替える
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+        results = {"ids": [[self.ids[i] for i in row] for row in top]}
+        if "documents" in include:
+            results["documents"] = [[self.documents[i] for i in row] for row in top]
+        if "metadatas" in include:
+            results["metadatas"] = [[self.metadatas[i] for i in row] for row in top]
+        if "distances" in include:
+            results["distances"] = (1.0 - top_scores).tolist()
+        return results
+
+    def scores(self, queries: np.ndarray) -> np.ndarray:
+        """正規化済みクエリ (n, 次元) に対する全件のコサイン類似度 (n, 件数)"""
+        if self.matrix is None:
+            # まだ1件も追加されていない
+            return np.empty((queries.shape[0], 0), dtype=np.float32)
+        total = self.matrix.shape[0]
+        out = np.empty((queries.shape[0], total), dtype=np.float32)
+        for start in range(0, total, QUERY_BLOCK):
+            block = np.asarray(self.matrix[start : start + QUERY_BLOCK], dtype=np.float32)
+            out[:, start : start + len(block)] = queries @ block.T
+        if self.scales is not None:
+            out *= self.scales
+        return out
+
+    def count(self):
+        return len(self.ids)
+
+
+# ===================================================
+# メタデータでの絞り込み
+# ===================================================
+# 指定できる条件と値の型
+FILTER_TYPES = {
+    "document": str,
+    "page_min": int,
+    "page_max": int,
+    "scope":    str,
+}
+
+
+def validate_filters(filters) -> dict:
+    """filters の形式を確認する（不正ならValueError）。Noneは空の条件として扱う"""
+    if filters is None:
+        return {}
+    if not isinstance(filters, dict):
+        raise ValueError("filters はオブジェクトで指定してください")
+    for key, value in filters.items():
+        if key not in FILTER_TYPES:
+            raise ValueError(f"未対応の絞り込み条件です: {key}（指定できるのは {', '.join(FILTER_TYPES)}）")
+        expected = FILTER_TYPES[key]
+        # JSONの true/false は int として通さない
+        if not isinstance(value, expected) or isinstance(value, bool):
+            raise ValueError(f"{key} には{'文字列' if expected is str else '整数'}を指定してください")
+    return filters
+
+
+def matches_filters(meta: dict, filters: dict) -> bool:
+    """
+    filters の条件（すべてAND）にメタデータが合うか
+      document: ファイル名が一致するもの
+      page_min / page_max: チャンクが載っているページ（page_num 〜 page_last）がこの範囲と重なるもの。
+                           重複除去でまとめたチャンク（例: pages "3,50"）は最初〜最後のページで判定する
+      scope: 災害種別（風水害 / 地震）。"共通" のチャンクはどの種別にも含める
+    ChromaDBの where（_to_chroma_where）と結果が同じになるよう、項目がないチャンクは条件に合わないものとする
+    （page_last がない従来のチャンクは page_num だけで判定する）
+    """
+    if "document" in filters and meta.get("document") != filters["document"]:
+        return False
+    page = meta.get("page_num")
+    last = meta.get("page_last", page)
+    if "page_min" in filters and (last is None or last < filters["page_min"]):
+        return False
+    if "page_max" in filters and (page is None or page > filters["page_max"]):
+        return False
+    if "scope" in filters and meta.get("scope") not in (filters["scope"], "共通"):
+        return False
+    return True
+
+
+def _to_chroma_where(filters: dict | None) -> dict | None:
+    """filters を ChromaDB の where 条件に変換する"""
+    if not filters:
+        return None
+    conditions = []
+    if "document" in filters:
+        conditions.append({"document": filters["document"]})
+    if "page_min" in filters:
+        # page_last がない従来のチャンクは page_num で判定する（page_last >= page_num なので新しいチャンクには影響しない）
+        conditions.append({"$or": [
+            {"page_last": {"$gte": filters["page_min"]}},
+            {"page_num":  {"$gte": filters["page_min"]}},
+        ]})
+    if "page_max" in filters:
+        conditions.append({"page_num": {"$lte": filters["page_max"]}})
+    if "scope" in filters:
+        conditions.append({"scope": {"$in": [filters["scope"], "共通"]}})
+    if not conditions:
+        return None
+    return conditions[0] if len(conditions) == 1 else {"$and": conditions}
+
+
+# ===================================================
+# インデックスのバージョン管理（再構築中も公開中のインデックスを壊さない）
+# ===================================================
+def _backend_path(backend: str) -> str:
+    if backend == "chroma":
+        return CHROMA_DB_PATH
+    if backend == "numpy":
+        return NUMPY_DB_PATH
+    raise ValueError(f"未対応のバックエンドです: {backend}")
+
+
+def _read_current_version(path: str) -> str | None:
+    current_file = os.path.join(path, _CURRENT_FILE)
+    if not os.path.exists(current_file):
+        return None
+    with open(current_file, "r", encoding="utf-8") as f:
+        return json.load(f)["version"]
+
+
+def _chroma_collection_name(version: str | None) -> str:
+    # バージョンがない（この仕組みより前に構築した）場合は従来のコレクション名
+    return f"{COLLECTION_NAME}_{version}" if version else COLLECTION_NAME
+
+
+def index_version(backend: str = VECTOR_BACKEND) -> str | None:
+    """
+    公開中のインデックスのバージョン（再構築の完了検知用）。
+    publish_vector_store() で切り替えたときだけ変わる。未公開・従来形式ならNone
+    """
+    return _read_current_version(_backend_path(backend))
+
+
+def publish_vector_store(store: VectorStore, backend: str = VECTOR_BACKEND):
+    """
+    create_vector_store() で作ったストアを公開中のインデックスに切り替える（構築の最後に呼ぶ）。
+    一時ファイルに書いてから置き換えるので、読む側が書きかけのファイルを見ることはない
+    """
+    path = _backend_path(backend)
+    tmp_path = os.path.join(path, _CURRENT_FILE + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"version": store.version}, f)
+    os.replace(tmp_path, os.path.join(path, _CURRENT_FILE))
+
+
+def _remove_old_versions(backend: str):
+    """
+    公開中以外の古いバージョンを削除する（新しいバージョンの構築を始める前に呼ぶ）。
+    公開中のものは検索サービスなどが開いている可能性があるので残す
+    """
+    path    = _backend_path(backend)
+    current = _read_current_version(path)
+
+    if backend == "chroma":
+        import chromadb
+        client = chromadb.PersistentClient(path=path)
+        keep = _chroma_collection_name(current)
+        for c in client.list_collections():
+            if c.name != keep and (c.name == COLLECTION_NAME or c.name.startswith(COLLECTION_NAME + "_")):
+                print(f"   古いコレクション '{c.name}' を削除します")
+                client.delete_collection(c.name)
+        return
+
+    if not os.path.exists(path):
+        return
+    for name in os.listdir(path):
+        full = os.path.join(path, name)
+        if os.path.isdir(full) and name != current:
+            # Windowsでは他のプロセスがメモリマップ中だと消せないので、その場合は次回に持ち越す
+            shutil.rmtree(full, ignore_errors=True)
+        elif current and name in (_EMB_FILE, _SCALE_FILE, _META_FILE):
+            # 従来形式（フォルダ直下）のファイルは、バージョン付きに切り替わった後なら不要
+            try:
+                os.remove(full)
+            except OSError:
+                pass
+
+
+# ===================================================
+# 内部ユーティリティ
+# ===================================================
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def _quantize(vectors: np.ndarray, dtype: str):
+    """正規化済みベクトルを保存用の型に変換する（int8は行ごとの対称量子化）"""
+    if dtype == "float16":
+        return vectors.astype(np.float16), None
+    if dtype == "int8":
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        matrix = np.round(vectors / scales[:, None]).astype(np.int8)
+        return matrix, scales.astype(np.float32)
+    raise ValueError(f"未対応のdtypeです: {dtype}")
+
+
+# ===================================================
+# バックエンドの切り替え
+# ===================================================
+def create_vector_store(backend: str = VECTOR_BACKEND) -> VectorStore:
+    """
+    新しいバージョンの空のベクトルストアを作る。
+    publish_vector_store() を呼ぶまでは、公開中のインデックスはそのまま検索に使われる
+    """
+    _remove_old_versions(backend)
+    version = datetime.now().strftime("%Y%m%d%H%M%S%f")
+
+    if backend == "chroma":
+        store = ChromaVectorStore.create(name=_chroma_collection_name(version))
+    else:
+        store = NumpyVectorStore.create(os.path.join(NUMPY_DB_PATH, version))
+    store.version = version
+    return store
+
+
+def open_vector_store(backend: str = VECTOR_BACKEND) -> VectorStore:
+    """構築済みのベクトルストアを開く"""
+    if backend == "chroma":
+        return ChromaVectorStore.open()
+    if backend == "numpy":
+        return NumpyVectorStore.open()
+    raise ValueError(f"未対応のバックエンドです: {backend}")
+
+
+def vector_store_exists(backend: str = VECTOR_BACKEND) -> bool:
+    """構築済みのベクトルストアがあるか（app.pyのステータス表示用）"""
+    if index_version(backend):
+        return True
+    # 従来形式（バージョン管理の導入前に構築したもの）
+    if backend == "chroma":
+        return os.path.exists(CHROMA_DB_PATH)
+    return os.path.exists(os.path.join(NUMPY_DB_PATH, _META_FILE))